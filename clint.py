@@ -2,20 +2,27 @@
 
 import argparse
 import ast
+import csv
 from datetime import datetime
 import glob
+import hashlib
 import json
 import logging
 import os
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 import readline
 import shutil
+from StringIO import StringIO
 import sys
+import traceback
 
 import bagit
 
+import fixity
 from inventory import Bag, BagAction, Collection, Item, Machine, Project
 import inventory as inv
+import settings
 
 
 log = logging.getLogger(__name__)
@@ -55,47 +62,96 @@ def ls(args):
             val = getattr(args, model.replace('_', ''))
             if val is not None and val != '':
                 params[model] = val
-    res = inv._get(model=args.model.replace('_', ''), params=params)
-    data = res.json()
-    if args.json:
-        print json.dumps(data, indent=2)
+    model = args.model.replace('_', '')
+    if args.all and args.concurrency > 1:
+        objects = (obj for page in inv.fetch_all(model, params=params,
+                   concurrency=args.concurrency) for obj in page['objects'])
     else:
-        objects = res.json().get('objects', None)
-        if not objects:
-            print 'No %ss found' % args.model
+        limit = None if args.all else args.limit
+        objects = inv.iterate(model, params=params, limit=limit,
+                              prefetch=True)
+    if args.json:
+        # stream the objects as a JSON list rather than holding them all
+        sys.stdout.write('[')
+        for index, obj in enumerate(objects):
+            if index:
+                sys.stdout.write(',')
+            sys.stdout.write('\n' + json.dumps(obj, indent=2))
+            sys.stdout.flush()
+        print '\n]'
+        return
+    count = 0
+    for index, obj in enumerate(objects, start=1):
+        count = index
+        print '-----%s-----' % index
+        if 'bagname' in obj.keys():
+            print 'bagname: %s' % obj.pop('bagname')
         else:
-            for index, obj in enumerate(objects, start=1):
-                print '-----%s-----' % index
-                if 'bagname' in obj.keys():
-                    print 'bagname: %s' % obj.pop('bagname')
-                else:
-                    print 'id: %s' % obj.pop('id')
-                if 'name' in obj.keys():
-                    print 'name: %s' % obj.pop('name')
-                elif 'title' in obj.keys():
-                    print 'title: %s' % obj.pop('title').encode('utf-8')
-                for k in sorted(obj.keys()):
-                    print '%s: %s' % (k, obj[k])
-            print '----------\n%s total %ss' % (len(objects), args.model)
+            print 'id: %s' % obj.pop('id')
+        if 'name' in obj.keys():
+            print 'name: %s' % obj.pop('name')
+        elif 'title' in obj.keys():
+            print 'title: %s' % obj.pop('title').encode('utf-8')
+        for k in sorted(obj.keys()):
+            print '%s: %s' % (k, obj[k])
+        sys.stdout.flush()
+    if not count:
+        print 'No %ss found' % args.model
+    else:
+        print '----------\n%s %ss listed' % (count, args.model)
 
 
 def show(args):
+    ids = list(args.id)
+    if args.stdin or ids == ['-']:
+        ids = [line.strip() for line in sys.stdin if line.strip()]
+    if not ids:
+        sys.exit('No %s ids given' % args.model)
+    if len(ids) > 1 and not args.local_id:
+        return show_many(args, ids)
+    for pk in ids:
+        show_one(args, pk)
+
+
+def show_one(args, pk):
     try:
         if args.local_id:
-            obj = globals()[args.model.capitalize()](local_id=args.id)
+            obj = globals()[args.model.capitalize()](local_id=pk)
         elif args.model == 'bag_action':
-            obj = globals()[args.model.title().replace('_', '')](args.id)
+            obj = globals()[args.model.title().replace('_', '')](pk)
         else:
-            obj = globals()[args.model.capitalize()](args.id)
+            obj = globals()[args.model.capitalize()](pk)
         if args.json:
             print json.dumps(obj.as_json, indent=2)
         else:
             print obj.to_string()
     except inv.Inventory404, e:
-        sys.exit('No record found for %s %s' % (args.model, args.id))
+        sys.exit('No record found for %s %s' % (args.model, pk))
     except Exception, e:
-        log.exception('Error fetching %s "%s"' % (args.model, args.id))
+        log.exception('Error fetching %s "%s"' % (args.model, pk))
+        sys.exit('Error fetching data: %s' % getattr(e, 'msg', e))
+
+
+def show_many(args, ids):
+    # fetch the objects (and their relations) in batches
+    cls = globals()[args.model.title().replace('_', '')]
+    try:
+        objs = cls.get_many(ids)
+    except inv.InventoryError, e:
+        log.exception('Error fetching %ss' % args.model)
         sys.exit('Error fetching data: %s' % e.msg)
+    if args.json:
+        print json.dumps([obj.as_json for obj in objs], indent=2)
+    else:
+        for obj in objs:
+            print obj.to_string()
+    missing = set(ids) - set('%s' % obj.id for obj in objs)
+    if missing:
+        for pk in ids:
+            if pk in missing:
+                sys.stderr.write('No record found for %s %s\n' %
+                                 (args.model, pk))
+        sys.exit(1)
 
 
 def add(args):
@@ -111,9 +167,8 @@ def add(args):
         # if no optional args passed, get metadata from user
         if vals == []:
             user_build_new_obj(obj, args.model)
-        if args.model == 'bag':
-            bag = bagit.Bag(obj.absolute_filesystem_path)
-            obj.payload = build_bag_payload(bag, obj.absolute_filesystem_path)
+        if args.model == 'bag' and not obj.payload:
+            obj.payload = build_bag_payload(obj.absolute_filesystem_path)
         obj.save()
         if args.json:
             print json.dumps(obj.as_json, indent=2)
@@ -155,14 +210,17 @@ def edit(args):
     try:
         edits = [a for a in obj.readwrite()
                  if getattr(args, a, None) is not None]
+        if args.model == 'bag':
+            old_path, old_payload = obj.absolute_filesystem_path, obj.payload
         for attr in edits:
             setattr(obj, attr, getattr(args, attr))
         # if no optional args passed, get metadata from user
         if edits == []:
             user_edit_obj(obj)
-        if args.model == 'bag':
-            bag = bagit.Bag(obj.absolute_filesystem_path)
-            obj.payload = build_bag_payload(bag, obj.absolute_filesystem_path)
+        # the payload only needs listing again if the bag has moved
+        if args.model == 'bag' and obj.payload == old_payload \
+                and obj.absolute_filesystem_path != old_path:
+            obj.payload = build_bag_payload(obj.absolute_filesystem_path)
         obj.save()
         if args.json:
             print json.dumps(obj.as_json, indent=2)
@@ -253,12 +311,35 @@ def get_user_input(obj, attr, opts, no_prefill=False):
         readline.set_startup_hook()
 
 
-def build_bag_payload(bagitbag, path):
-    payload = []
-    for f in bagitbag.payload_files():
-        size = os.path.getsize(os.path.join(path, f))
-        payload.append('%s %s' % (f, size))
-    return '\n'.join(payload)
+def algorithm_list(value):
+    # argparse type for a comma separated list of checksum algorithms
+    algorithms = [a.strip().lower() for a in value.split(',') if a.strip()]
+    for algorithm in algorithms:
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            raise argparse.ArgumentTypeError('unknown algorithm %s' %
+                                             algorithm)
+    return algorithms
+
+
+def hash_cache(args):
+    # the digest cache for bag and rebag, None when disabled
+    if settings.HASH_CACHE_PATH and not getattr(args, 'no_cache', False):
+        return fixity.HashCache(settings.HASH_CACHE_PATH)
+
+
+def build_bag_payload(path, files=None):
+    # list the payload as Inventory stores it, a "relpath size" line per
+    # file, from (relpath, size) pairs collected while hashing if there are
+    # some, otherwise from a single walk of the bag. The lines are streamed
+    # into the request rather than joined into one string
+    if not os.path.exists(os.path.join(path, 'bagit.txt')):
+        raise bagit.BagError('Expected bagit.txt does not exist: %s' %
+                             os.path.join(path, 'bagit.txt'))
+    if files is None:
+        return inv.Payload(lambda: fixity.walk(path))
+    return inv.Payload(lambda: files)
 
 
 def bag(args):
@@ -314,7 +395,15 @@ def bag(args):
                 params = ast.literal_eval(bag_args.params)
 
         # first create the bag
-        bag = bagit.make_bag(args.path, params)
+        cache = hash_cache(args)
+        try:
+            bag, files = fixity.make_bag(args.path, params,
+                                         processes=args.processes,
+                                         algorithms=args.algorithms,
+                                         cache=cache, resume=args.resume)
+        finally:
+            if cache:
+                cache.close()
         if args.json:
             print json.dumps(bag.as_json, indent=2)
         else:
@@ -322,8 +411,6 @@ def bag(args):
             pprint(bag.entries)
         # also create the inventory object
         obj = Bag()
-        # load payload
-        obj.payload = build_bag_payload(bag, args.path)
         # load path and bagname values
         bagdir, bagname = os.path.split(args.path)
         obj.bagname = bagname
@@ -361,10 +448,14 @@ def bag(args):
             newpath = os.path.join(dirname, obj.bagname.replace('/', '_'))
             shutil.move(args.path, newpath)
             obj.path = newpath
+        # unless one was given, load the payload, as listed while hashing,
+        # from where the bag is now
+        if not obj.payload:
+            obj.payload = build_bag_payload(obj.path, files)
         obj.save()
 
         #Change permissions for the 'data' directory inside the bagged folder
-        datapath = os.path.join(obj.absolute_filesystem_path, 'data')
+        datapath = os.path.join(obj.path, 'data')
         os.chmod(datapath, 0755)
 
         if args.json:
@@ -388,73 +479,407 @@ def bag(args):
 
 
 def rebag(args):
-    # Ideally, this behavior should be included in the bagit.py package
-    # remove bag info and manifest files
+    """Updates the manifests of a Bag whose payload has had files added,
+    changed or removed. Only new and changed files are hashed, checksums of
+    the rest are kept; --full rehashes everything. Either way data/ is left
+    where it is. The Bag's payload in Inventory is updated and an 'updated'
+    BagAction recorded."""
     bagpath = args.path
-    bagname = os.path.basename(bagpath)
-    for f in os.listdir(bagpath):
-        fpath = os.path.join(bagpath, f)
-        if os.path.isfile(fpath):
-            os.remove(fpath)
-    # move subdirs in data back to bag root
-    datapath = os.path.join(bagpath, 'data')
-    for subd in os.listdir(datapath):
-        shutil.move(os.path.join(datapath, subd), os.path.join(bagpath, subd))
-    # remove data dir
-    os.removedirs(datapath)
-    # bag it again
-    bag = bagit.make_bag(args.path)
-    print 'Bag updated!'
-    pprint(bag.entries)
-    # also create the inventory object
-    obj = Bag(bagname=bagname)
-    obj._load_properties()
-    # load payload
-    obj.payload = build_bag_payload(bag, bagpath)
+    info_path = os.path.join(bagpath, 'bag-info.txt')
+    info = fixity.read_tag_file(info_path) if os.path.exists(info_path) else {}
+    bag_id = info.get('Bag-Id', os.path.basename(os.path.normpath(bagpath)))
+    obj = Bag(id=bag_id)
+    try:
+        obj._load_properties()
+    except inv.Inventory404:
+        print 'Bag %s is not registered with Inventory' % bag_id
+        obj = None
+    sizes = {}
+    if obj and obj.payload:
+        for line in obj.payload.splitlines():
+            # a line that doesn't parse leaves that file's size unknown
+            try:
+                relpath, size = line.rsplit(' ', 1)
+                sizes[relpath] = int(size)
+            except ValueError:
+                continue
+    full = getattr(args, 'full', False)
+    # a full rebag reads every file, so it has no use for the cache
+    cache = None if full else hash_cache(args)
+    try:
+        result = fixity.update_bag(bagpath, processes=args.processes,
+                                   sizes=sizes, full=full, cache=cache)
+    finally:
+        if cache:
+            cache.close()
+    files = result['files']
+    if full:
+        print 'Bag updated! %s files rehashed' % len(files)
+    else:
+        print 'Bag updated! %s added, %s changed, %s removed' % (
+            len(result['added']), len(result['changed']),
+            len(result['removed']))
+    if obj is None:
+        return
+    # also update the inventory object
+    obj.payload = build_bag_payload(bagpath, files)
     obj.save()
-    action = BagAction(bag=bagname, timestamp=str(datetime.now()),
+    action = BagAction(bag=obj.id, timestamp=str(datetime.now()),
                        action='1', note='initiated by clint')
     action.save()
     print 'Action recorded in Inventory'
 
 
 def validate(args):
-    """Validates if the Bag is valid or not. This function uses the
-    bagit's 'validate' method to match file checksums. If the folder
-    structure of the Bag provided is incorrect, bagit throws an error
-    which is handled in the 'except' block. If the checksum validations
-    fail, this function exits by displaying a message in the 'else' part of
-    the outermost 'if' statement. In order to view which files have failed
-    checksum valdiation, logging level must be set to DEBUG in the settings
-    file"""
-    try:
-        bag = bagit.Bag(args.path)
-        if bag.is_valid():
-            if 'Bag-Id' in bag.info:
-                bag_id = bag.info['Bag-Id']
-                action = BagAction(bag=bag_id, timestamp=str(datetime.now()),
-                                   action='3', note='initiated by clint')
-                action.save()
-                if args.json:
-                    print json.dumps(action.as_json, indent=2)
-                else:
-                    print 'Bag is valid!'
-                    print 'action id: %s' % action.id
-                    print action.to_string()
-            else:
-                print 'Bag is valid, but not registered with Inventory.'
+    """Validates if the Bag is valid or not. The payload is hashed against
+    the manifests by a pool of --processes workers, streaming the manifest
+    rather than loading it, and each problem found is printed to stderr as
+    soon as it is found. If the Bag is valid and registered with Inventory
+    a 'validated' BagAction is recorded. With --fast nothing is hashed, only
+    the structure, file presence and Payload-Oxum are checked."""
+    level = 'fast' if args.fast else 'full'
+    problems = 0
+    for problem in fixity.check_bag(args.path, processes=args.processes,
+                                    fast=args.fast):
+        problems += 1
+        print >> sys.stderr, problem
+    if problems:
+        sys.exit('Bag is NOT valid, %s problem(s) found' % problems)
+    info_path = os.path.join(args.path, 'bag-info.txt')
+    info = fixity.read_tag_file(info_path) if os.path.exists(info_path) else {}
+    if 'Bag-Id' in info:
+        bag_id = info['Bag-Id']
+        action = BagAction(bag=bag_id, timestamp=str(datetime.now()),
+                           action='3',
+                           note='%s validation initiated by clint' % level)
+        action.save()
+        if args.json:
+            print json.dumps(action.as_json, indent=2)
         else:
-            sys.exit('Bag is NOT valid')
-    except bagit.BagError,  e:
-        sys.exit('Bag is NOT valid.\n' + e.message)
+            print 'Bag is valid! (%s validation)' % level
+            print 'action id: %s' % action.id
+            print action.to_string()
+    else:
+        print 'Bag is valid, but not registered with Inventory.'
+
+
+def registered_source(source_dir):
+    # the Inventory Bag a bag on disk was registered as, if it was
+    info_path = os.path.join(source_dir, 'bag-info.txt')
+    info = fixity.read_tag_file(info_path) if os.path.exists(info_path) else {}
+    if 'Bag-Id' not in info:
+        return None, info
+    try:
+        source = Bag(id=info['Bag-Id'])
+        source._load_properties()
+    except inv.Inventory404, e:
+        sys.exit('No record found for bag %s' % info['Bag-Id'])
+    return source, info
+
+
+def register_copy(source, info, target, machine=None, bagname=None,
+                  bag_type=None, path=None):
+    # register a verified copy of source as a new Bag
+    obj = Bag(bagname=bagname or source.bagname, item=source.item,
+              machine=machine or source.machine,
+              bag_type=bag_type or source.bag_type,
+              absolute_filesystem_path=path or os.path.abspath(target),
+              created=str(datetime.now()),
+              payload=build_bag_payload(target))
+    obj.save()
+    # the copy carries its own Bag-Id, so actions on it are recorded
+    # against the new Bag
+    target_info = os.path.join(target, 'bag-info.txt')
+    info = dict(info, **{'Bag-Id': obj.id})
+    fixity.write_tag_file(target_info, info)
+    fixity.write_tagmanifests(target, [algorithm for algorithm, path in
+                              fixity.manifests(target, 'tagmanifest')]
+                              or ['md5'])
+    action = BagAction(bag=obj.id, timestamp=str(datetime.now()),
+                       action='5', note='copied from bag %s and verified by '
+                       'clint' % source.id)
+    action.save()
+    return obj
 
 
 def copy(args):
-    pass
+    """Copies a Bag to target with --threads parallel streams, hashing
+    each file as it is copied and checking it against the source manifests,
+    so the replica is verified without being read again. If the source Bag
+    is registered with Inventory the copy is registered as a new Bag, its
+    Bag-Id written into the copy's bag-info, and an 'added' BagAction
+    recorded."""
+    problems = 0
+    for problem in fixity.copy_bag(args.source, args.target,
+                                   threads=args.threads):
+        problems += 1
+        print >> sys.stderr, problem
+    if problems:
+        sys.exit('Copy failed, %s problem(s) found' % problems)
+    print 'Bag copied and verified'
+    source, info = registered_source(args.source)
+    if source is None:
+        print 'Source Bag is not registered with Inventory, nor is the copy.'
+        return
+    obj = register_copy(source, info, args.target, args.machine,
+                        args.bagname, args.bag_type, args.path)
+    if args.json:
+        print json.dumps(obj.as_json, indent=2)
+    else:
+        print obj.to_string()
+
+
+def replica_target(value):
+    # argparse type for --target MACHINE:PATH
+    machine, sep, path = value.partition(':')
+    if not sep or not machine or not path:
+        raise argparse.ArgumentTypeError(
+            'expected MACHINE:PATH, got %s' % value)
+    return machine, path
+
+
+def replicate(args):
+    """Copies a Bag to several targets at once, reading each source file
+    once and writing it to every target in parallel, hashing it as it is
+    read and checking it against the source manifests. Each replica that
+    was written without problems is registered as a new Bag on its
+    machine, as copy does; the exit status is 1 if any replica failed."""
+    targets = [os.path.abspath(path) for machine, path in args.target]
+    if len(set(targets)) < len(targets):
+        sys.exit('The same path is given more than once')
+    failed = set()
+    for target, problem in fixity.replicate_bag(args.source, targets,
+                                                threads=args.threads):
+        print >> sys.stderr, problem
+        failed.update([target] if target else targets)
+    replicas = [(machine, path) for machine, path in args.target
+                if os.path.abspath(path) not in failed]
+    for path in sorted(failed):
+        print >> sys.stderr, 'Replica %s failed' % path
+    if replicas:
+        print '%s replica(s) copied and verified' % len(replicas)
+        source, info = registered_source(args.source)
+        if source is None:
+            print 'Source Bag is not registered with Inventory, nor are ' \
+                'the replicas.'
+        else:
+            objs = [register_copy(source, info, path, machine)
+                    for machine, path in replicas]
+            if args.json:
+                print json.dumps([obj.as_json for obj in objs], indent=2)
+            else:
+                for obj in objs:
+                    print obj.to_string()
+    if failed:
+        sys.exit(1)
 
 
 def move(args):
-    print 'Move operations not supported yet'
+    """Moves a Bag to target. When both are on the same filesystem this is
+    a single rename, otherwise the Bag is copied and verified as copy does
+    and the source deleted once the copy checks out. The Bag's path (and
+    machine, with -m) is updated in Inventory and a 'moved' BagAction
+    recorded."""
+    info_path = os.path.join(args.source, 'bag-info.txt')
+    info = fixity.read_tag_file(info_path) if os.path.exists(info_path) else {}
+    bag_id = info.get('Bag-Id',
+                      os.path.basename(os.path.normpath(args.source)))
+    obj = Bag(id=bag_id)
+    try:
+        obj._load_properties()
+    except inv.Inventory404, e:
+        if 'Bag-Id' in info:
+            sys.exit('No record found for bag %s' % bag_id)
+        obj = None
+    rename = fixity.same_device(args.source, args.target)
+    how = 'renamed' if rename else 'copied, verified and deleted'
+    problems = 0
+    for problem in fixity.move_bag(args.source, args.target,
+                                   threads=args.threads, rename=rename):
+        problems += 1
+        print >> sys.stderr, problem
+    if problems:
+        sys.exit('Move failed, %s problem(s) found. The source is left in '
+                 'place' % problems)
+    print 'Bag moved (%s)' % how
+    if obj is None:
+        print 'Bag %s is not registered with Inventory.' % bag_id
+        return
+    old_path = obj.absolute_filesystem_path
+    obj.absolute_filesystem_path = args.path or os.path.abspath(args.target)
+    if args.machine:
+        obj.machine = args.machine
+    try:
+        obj.save()
+    except Exception, e:
+        # the bag is only at its new path now, so say where it went
+        sys.exit('Bag moved to %s, but updating bag %s in Inventory failed: '
+                 '%s\nSet its path with: clint edit bag %s -p %s' % (
+                     args.target, obj.id, getattr(e, 'msg', e), obj.id,
+                     obj.absolute_filesystem_path))
+    action = BagAction(bag=obj.id, timestamp=str(datetime.now()),
+                       action='2', note='moved from %s (%s) by clint' %
+                       (old_path, how))
+    action.save()
+    if args.json:
+        print json.dumps(obj.as_json, indent=2)
+    else:
+        print obj.to_string()
+
+
+# spreadsheet columns of an import, by CSV header and XLS column order,
+# the same layout clint-fabutils.py has always read
+import_columns = [('collection', 'Collection ID'), ('title', 'Item Name'),
+                  ('local_id', 'Local ID'),
+                  ('original_item_type', 'Item Type'),
+                  ('notes', 'Item Notes'),
+                  ('access_loc', 'Item Access Location'),
+                  ('bagname', 'Bag Name'), ('path', 'Bag Path'),
+                  ('bag_type', 'Bag Type'), ('machine', 'Machine ID')]
+
+
+def read_import_file(filename):
+    # yield a dict of import_columns per row of a CSV or XLS/XLSX file
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        with open(filename) as f:
+            for row in csv.DictReader(f):
+                yield dict((key, row.get(header, '') or '')
+                           for key, header in import_columns)
+    elif extension in ['.xls', '.xlsx']:
+        from xlrd import open_workbook
+        workbook = open_workbook(filename)
+        for sheet in workbook.sheets():
+            for rownum in range(1, sheet.nrows):
+                values = sheet.row_values(rownum)
+                row = dict(zip([key for key, header in import_columns],
+                               values))
+                # numeric cells come back as floats, so 1234 reads 1234.0
+                for key, value in row.items():
+                    if isinstance(value, float) and value.is_integer():
+                        row[key] = str(int(value))
+                yield row
+    else:
+        raise ValueError('Invalid file: %s, expected .csv, .xls or .xlsx' %
+                         filename)
+
+
+def import_row(row, fast=False):
+    # register one row: its item, its bag and the bag's validation. The
+    # bag is validated first, and if registering fails part way the item
+    # and bag already saved are deleted again, so the row can be retried
+    payload = build_bag_payload(row['path'])
+    problems = list(fixity.check_bag(row['path'], fast=fast))
+    if problems:
+        raise fixity.BagProblems(problems)
+    saved = []
+    try:
+        item = Item(title=row['title'], local_id=row['local_id'],
+                    collection=row['collection'],
+                    original_item_type=row['original_item_type'],
+                    notes=row['notes'], access_loc=row['access_loc'])
+        item.save()
+        saved.append(('item', item.id))
+        obj = Bag(bagname=row['bagname'], bag_type=row['bag_type'],
+                  absolute_filesystem_path=row['path'],
+                  machine=row['machine'], item=item,
+                  created=str(datetime.now()), payload=payload)
+        obj.save()
+        saved.append(('bag', obj.id))
+        BagAction(bag=obj.id, timestamp=str(datetime.now()), action='5',
+                  note='imported by clint').save()
+        level = 'fast' if fast else 'full'
+        BagAction(bag=obj.id, timestamp=str(datetime.now()), action='3',
+                  note='%s validation initiated by clint' % level).save()
+    except Exception, e:
+        error = sys.exc_info()
+        left = []
+        for model, pk in reversed(saved):
+            try:
+                removed = inv._delete(model, pk).status_code in [200, 202,
+                                                                 204]
+            except Exception:
+                removed = False
+            if not removed:
+                left.append('%s %s' % (model, pk))
+        if left:
+            raise RuntimeError('%s; %s still registered, delete before '
+                               'importing the row again' % (
+                                   e or e.__class__.__name__,
+                                   ' and '.join(left)))
+        raise error[0], error[1], error[2]
+    return item, obj
+
+
+def _import_task(task):
+    rownum, row, fast = task
+    try:
+        item, obj = import_row(row, fast)
+        return rownum, row, item.id, obj.id, None
+    except fixity.BagProblems, e:
+        return rownum, row, None, None, 'Bag is NOT valid: %s' % \
+            '; '.join(e.problems)
+    except Exception, e:
+        log.debug(traceback.format_exc())
+        return rownum, row, None, None, '%s' % (e or e.__class__.__name__)
+
+
+def import_file(args):
+    """Imports a CSV or XLS/XLSX spreadsheet of items and their bags. For
+    each row the item and the bag are registered, the bag validated and
+    the actions recorded, with --concurrency rows in progress at once over
+    one pool of connections. A row that fails is reported and the others
+    carry on; the exit status is 1 if any row failed."""
+    try:
+        rows = list(read_import_file(args.file))
+    except (IOError, ValueError), e:
+        sys.exit('%s' % e)
+    tasks = [(rownum, row, args.fast) for rownum, row in
+             enumerate(rows, start=2)]
+    pool = ThreadPool(max(args.concurrency, 1))
+    failed, results = 0, []
+    try:
+        for rownum, row, item_id, bag_id, error in pool.imap_unordered(
+                _import_task, tasks):
+            if error:
+                failed += 1
+                print >> sys.stderr, 'row %s (%s): %s' % (
+                    rownum, row['bagname'], error)
+            elif not args.json:
+                print 'row %s: added item %s and bag %s (%s)' % (
+                    rownum, item_id, bag_id, row['bagname'])
+            results.append({'row': rownum, 'bagname': row['bagname'],
+                            'item': item_id, 'bag': bag_id, 'error': error})
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    if args.json:
+        print json.dumps(sorted(results, key=lambda r: r['row']), indent=2)
+    else:
+        print '%s of %s rows imported' % (len(rows) - failed, len(rows))
+    if failed:
+        sys.exit(1)
+
+
+def cache(args):
+    store = inv.HTTPCache()
+    if not store.path:
+        sys.exit('The response cache is not enabled, '
+                 'set INVENTORY_CACHE_DIR in local_settings.py')
+    if args.action == 'clear':
+        print 'Removed %s cached responses' % store.clear()
+        return
+    stats = store.stats()
+    if args.json:
+        print json.dumps(stats, indent=2)
+    else:
+        print 'cache dir: %s' % stats['path']
+        print '      ttl: %ss' % stats['ttl']
+        print '  entries: %s (%s fresh)' % (stats['entries'], stats['fresh'])
+        print '     size: %s bytes' % stats['bytes']
+        if stats['oldest'] is not None:
+            print '   oldest: %ds old' % stats['oldest']
 
 
 #This function is set as a completer for readline
@@ -464,12 +889,85 @@ def complete(text, state):
     return (glob.glob(text + '*') + [None])[state]
 
 
-def main():
+def run_command(parser, argv):
+    """Runs one clint command in this process and returns its exit status,
+    output and error output. The command runs as if -j was given, with no
+    input to read, so a command that would prompt fails instead."""
+    stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+    out, err = StringIO(), StringIO()
+    client = inv.default_client()
+    sys.stdin, sys.stdout, sys.stderr = StringIO(), out, err
+    try:
+        try:
+            args = parser.parse_args(argv)
+            if args.func == serve:
+                raise ValueError('serve cannot be run from serve')
+            args.json = True
+            if args.no_cache:
+                inv.set_default_client(inv.InventoryClient(cache=False))
+            args.func(args)
+            status = 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print >> err, e.code
+                status = 1
+        except EOFError:
+            print >> err, 'Command needs input, give its options instead'
+            status = 1
+        except Exception, e:
+            log.debug(traceback.format_exc())
+            print >> err, 'Error: %s' % (e or e.__class__.__name__)
+            status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+        inv.set_default_client(client)
+    return status, out.getvalue(), err.getvalue()
+
+
+def serve(args):
+    """Reads one command per line from stdin, as a JSON object such as
+    {"id": 1, "argv": ["show", "bag", "12"]}, and writes one JSON object per
+    line to stdout with the same id, the exit status, the command's output
+    (parsed, if it is JSON) and its error output. Commands run one after
+    another in this process, sharing its connections and caches."""
+    parser = make_parser()
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        command = None
+        try:
+            command = json.loads(line)
+            argv = command['argv']
+            if not isinstance(argv, list):
+                raise ValueError('argv must be a list')
+            argv = [a.encode('utf8') if isinstance(a, unicode) else '%s' % a
+                    for a in argv]
+        except (ValueError, KeyError, TypeError), e:
+            command = command if isinstance(command, dict) else {}
+            result = {'status': 2, 'output': None,
+                      'error': 'Invalid command: %s' % e}
+        else:
+            status, output, error = run_command(parser, argv)
+            try:
+                output = json.loads(output) if output.strip() else None
+            except ValueError:
+                pass
+            result = {'status': status, 'output': output, 'error': error}
+        result['id'] = command.get('id')
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+
+def make_parser():
     # create clint level parser
     parser = argparse.ArgumentParser(
         description='A command line tool for Inventory operations')
     parser.add_argument('-j', '--json', action='store_true',
                         default=False, help='render output as JSON')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='bypass the on-disk response and hash caches')
 
     # add subparsers for each command
     subparsers = parser.add_subparsers()
@@ -479,19 +977,32 @@ def main():
         help='Display metadata for an Inventory object')
     show_parser.add_argument('model', choices=models,
         help='type of object to be acted on')
-    show_parser.add_argument('id', help='identifier of the object')
+    show_parser.add_argument('id', nargs='*',
+        help='identifier(s) of the object(s), or - to read them from stdin')
     show_parser.add_argument('-l', '--local_id', action="store_true",
         help='Set if you wish to use a local identifier (barcode)')
+    show_parser.add_argument('--stdin', action='store_true', default=False,
+        help='Read identifiers from stdin, one per line')
     show_parser.set_defaults(func=show)
 
     #parser for the "list" command
     list_parser = subparsers.add_parser('list',
                                         help='List objects in the inventory')
     list_parser.set_defaults(func=ls)
+    # paging options shared by each kind of object
+    list_opts = argparse.ArgumentParser(add_help=False)
+    list_opts.add_argument('--limit', type=int, default=20,
+                           help='Maximum number of objects to list')
+    list_opts.add_argument('--all', action='store_true', default=False,
+                           help='List every matching object (ignores --limit)')
+    list_opts.add_argument('--concurrency', type=int,
+                           default=settings.INVENTORY_CONCURRENCY,
+                           help='Pages fetched in parallel with --all')
     # add subparsers for each kind of object
     listsubpar = list_parser.add_subparsers()
     # list collection
     listc = listsubpar.add_parser('collection',
+                                  parents=[list_opts],
                                   help='List collections in Inventory')
     listc.add_argument('-n', '--name', help='Name of the Collection')
     listc.add_argument('-d', '--description',
@@ -502,13 +1013,17 @@ def main():
                        help='Local identifier of the Collection')
     listc.add_argument('--model', default='collection')
     # add project
-    listp = listsubpar.add_parser('project', help='Add a project to Inventory')
+    listp = listsubpar.add_parser('project',
+                                  parents=[list_opts],
+                                  help='Add a project to Inventory')
     listp.add_argument('-n', '--name', help='Name of the project')
     listp.add_argument('-c', '--collection',
                        help='ID of the collection this project feeds')
     listp.add_argument('--model', default='project')
     # add item
-    listi = listsubpar.add_parser('item', help='Add an item to Inventory')
+    listi = listsubpar.add_parser('item',
+                                  parents=[list_opts],
+                                  help='Add an item to Inventory')
     listi.add_argument('-t', '--title', help='Title of the item')
     listi.add_argument('-l', '--local_id', help='Alt/local ID of the item')
     listi.add_argument('-p', '--project',
@@ -520,7 +1035,9 @@ def main():
     listi.add_argument('-n', '--notes', help='Notes about the item')
     listi.add_argument('--model', default='item')
     # add bag
-    listb = listsubpar.add_parser('bag', help='Add a bag to the Inventory')
+    listb = listsubpar.add_parser('bag',
+                                  parents=[list_opts],
+                                  help='Add a bag to the Inventory')
     listb.add_argument('-n', '--bagname', help='Identifier/name of the bag')
     listb.add_argument('-t', '--bag_type', choices=bag_types,
                        help='Type of bag')
@@ -532,6 +1049,7 @@ def main():
     listb.add_argument('--model', default='bag')
     # add machine
     listm = listsubpar.add_parser('machine',
+                                  parents=[list_opts],
                                   help='Add a machine to the Inventory')
     listm.add_argument('-n', '--name', help='Name of the machine')
     listm.add_argument('-u', '--url', help='URL of the machine')
@@ -540,6 +1058,7 @@ def main():
     listm.add_argument('--model', default='machine')
 
     listba = listsubpar.add_parser('bag_action',
+                                   parents=[list_opts],
                                    help='Record a bag action in Inventory')
     listba.add_argument('-b', '--bag', help='System identifier of the Bag')
     listba.add_argument('-t', '--timestamp',
@@ -661,7 +1180,8 @@ def main():
     editb.add_argument('id', help='Identifier/name of the bag')
     editb.add_argument('-t', '--bag_type', choices=bag_types,
         help='Type of bag')
-    editb.add_argument('-p', '--path', help='Path to bag from server root')
+    editb.add_argument('-p', '--path', help='Path to bag from server root',
+                       dest='absolute_filesystem_path')
     editb.add_argument('-y', '--payload', help='Payload of the bag')
     editb.add_argument('-m', '--machine', help='Machine this bag is stored on')
     editb.add_argument('-i', '--item', help='Item this bag is associated with')
@@ -704,6 +1224,15 @@ def main():
 
     # parser for the "bag" command
     bag_parser = subparsers.add_parser('bag', help='Make a bag')
+    bag_parser.add_argument('--processes', type=int,
+        default=settings.BAG_PROCESSES,
+        help='Number of processes used to hash files (before the path)')
+    bag_parser.add_argument('--algorithms', type=algorithm_list,
+        default=settings.BAG_ALGORITHMS,
+        help='Comma separated checksum algorithms, e.g. md5,sha256 '
+             '(before the path)')
+    bag_parser.add_argument('--resume', action='store_true', default=False,
+        help='Carry on with a bag that was interrupted (before the path)')
     bag_parser.add_argument('path',
         help='Relative path of directory to convert to a bag')
     bag_parser.add_argument('remainder', nargs=argparse.REMAINDER)
@@ -712,23 +1241,93 @@ def main():
     rebag_parser = subparsers.add_parser('rebag',
         help='Repackage and rehash a bag')
     rebag_parser.add_argument('path', help='Relative path to the bag')
+    rebag_parser.add_argument('--processes', type=int,
+        default=settings.BAG_PROCESSES,
+        help='Number of processes used to hash files')
+    rebag_parser.add_argument('--full', action='store_true', default=False,
+        help='Rehash every file, not only new and changed ones')
     rebag_parser.set_defaults(func=rebag)
 
     valid_parser = subparsers.add_parser('validate', help='Validate a bag')
     valid_parser.add_argument('path', help='Relative path to the bag')
+    valid_parser.add_argument('--processes', type=int,
+        default=settings.BAG_PROCESSES,
+        help='Number of processes used to hash files')
+    level_group = valid_parser.add_mutually_exclusive_group()
+    level_group.add_argument('--fast', action='store_true', default=False,
+        help='Only check structure, file presence and Payload-Oxum')
+    level_group.add_argument('--full', action='store_false', dest='fast',
+        help='Re-hash every file against the manifests (default)')
     valid_parser.set_defaults(func=validate)
 
     copy_parser = subparsers.add_parser('copy', help='Copy a bag')
     copy_parser.add_argument('source', help='Relative path to the source bag')
     copy_parser.add_argument('target', help='Relative path to the target bag')
+    copy_parser.add_argument('--threads', type=int,
+        default=settings.COPY_THREADS,
+        help='Number of files copied at once')
+    copy_parser.add_argument('-m', '--machine',
+        help='Machine the copy is stored on (default: the source\'s)')
+    copy_parser.add_argument('-n', '--bagname',
+        help='Name of the copy (default: the source\'s)')
+    copy_parser.add_argument('-t', '--bag_type', choices=bag_types,
+        help='Type of the copy (default: the source\'s)')
+    copy_parser.add_argument('-p', '--path',
+        help='Path to the copy from server root (default: target)')
     copy_parser.set_defaults(func=copy)
 
+    replicate_parser = subparsers.add_parser('replicate',
+        help='Copy a bag to several machines, reading it once')
+    replicate_parser.add_argument('source',
+        help='Relative path to the source bag')
+    replicate_parser.add_argument('--target', action='append',
+        required=True, type=replica_target, metavar='MACHINE:PATH',
+        help='Machine id and path of a replica, repeat for each replica')
+    replicate_parser.add_argument('--threads', type=int,
+        default=settings.COPY_THREADS,
+        help='Number of files copied at once')
+    replicate_parser.set_defaults(func=replicate)
+
     move_parser = subparsers.add_parser('move', help='Move a bag')
     move_parser.add_argument('source', help='Relative path to the source bag')
     move_parser.add_argument('target', help='Relative path to the target bag')
+    move_parser.add_argument('--threads', type=int,
+        default=settings.COPY_THREADS,
+        help='Number of files copied at once across filesystems')
+    move_parser.add_argument('-m', '--machine',
+        help='Machine the bag is moved to (default: unchanged)')
+    move_parser.add_argument('-p', '--path',
+        help='Path to the bag from server root (default: target)')
     move_parser.set_defaults(func=move)
 
-    args = parser.parse_args()
+    import_parser = subparsers.add_parser('import',
+        help='Import a spreadsheet (CSV, XLS or XLSX) of items and bags')
+    import_parser.add_argument('file', help='Spreadsheet to import')
+    import_parser.add_argument('--concurrency', type=int,
+        default=settings.INVENTORY_CONCURRENCY,
+        help='Number of rows imported at once')
+    import_parser.add_argument('--fast', action='store_true', default=False,
+        help='Validate bags with a fast check instead of a full one')
+    import_parser.set_defaults(func=import_file)
+
+    cache_parser = subparsers.add_parser('cache',
+        help='Inspect or empty the on-disk response cache')
+    cache_parser.add_argument('action', choices=['stats', 'clear'])
+    cache_parser.set_defaults(func=cache)
+
+    serve_parser = subparsers.add_parser('serve',
+        help='Run commands read as JSON lines, one JSON result per line')
+    serve_parser.add_argument('--stdio', action='store_true', required=True,
+        help='Read commands from stdin and write results to stdout')
+    serve_parser.set_defaults(func=serve)
+
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    if args.no_cache:
+        inv.set_default_client(inv.InventoryClient(cache=False))
     args.func(args)
 
     sys.exit(0)
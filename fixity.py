@@ -0,0 +1,1044 @@
+from collections import deque
+from contextlib import contextmanager
+from datetime import date
+import glob
+import hashlib
+import io
+import json
+import logging
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+import bagit
+
+import settings
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+log = logging.getLogger('fixity')
+
+'''
+Checksumming for bags
+
+bagit.make_bag hashes a bag's payload one file at a time and only writes
+the manifest once every file is done. The functions here spread the
+hashing over a pool of worker processes and write manifest lines as the
+results come back, so a large bag can use every core on a storage host.
+'''
+BAGIT_TXT = 'BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n'
+SOFTWARE_AGENT = 'clint <https://github.com/gwu-libraries/clint>'
+JOURNAL = '.clint-journal'
+# payload file names are summed up as sha1 numbers modulo this
+NAME_HASH_MODULUS = 2 ** 160
+
+
+_buffers = threading.local()
+
+
+def _buffer(size):
+    # one read buffer per thread (and so per worker process), reused
+    if getattr(_buffers, 'buf', None) is None or len(_buffers.buf) != size:
+        _buffers.buf = bytearray(size)
+    return _buffers.buf
+
+
+def hash_file(path, algorithms=('md5',), block_size=None):
+    """
+    Read a file once, feeding each block to a hash for every algorithm.
+    Returns a dict of algorithm to hex digest, and the size in bytes.
+    Blocks of block_size (settings.HASH_BLOCK_SIZE by default) are read
+    into the same preallocated buffer each time.
+    """
+    buf = _buffer(block_size or settings.HASH_BLOCK_SIZE)
+    view = memoryview(buf)
+    checksums = [(algorithm, hashlib.new(algorithm))
+                 for algorithm in algorithms]
+    size = 0
+    with io.open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for algorithm, checksum in checksums:
+                checksum.update(view[:n])
+            size += n
+    return dict((a, c.hexdigest()) for a, c in checksums), size
+
+
+def _hash_task(task):
+    # worker side of hash_files, must be a module level function to pickle
+    relpath, fullpath, algorithms = task
+    digests, size = hash_file(fullpath, algorithms)
+    return relpath, size, digests
+
+
+def _scandir(bag_dir, reldir):
+    # one directory read per directory and one stat per file
+    entries = sorted(scandir(os.path.join(bag_dir, reldir)),
+                     key=lambda entry: entry.name)
+    for entry in entries:
+        relpath = '%s/%s' % (reldir, entry.name)
+        if entry.is_dir():
+            # like os.walk, list symlinked directories but don't follow them
+            if not entry.is_symlink():
+                for found in _scandir(bag_dir, relpath):
+                    yield found
+        else:
+            yield relpath, entry.stat()
+
+
+def scan(bag_dir, top='data'):
+    """
+    Yield (relpath, stat) for every file below top, with relpath relative
+    to bag_dir and '/' separated as the BagIt spec requires. Uses scandir,
+    from os or the scandir package, when there is one, which saves a stat
+    per file over os.walk.
+    """
+    if scandir is not None:
+        for found in _scandir(bag_dir, top):
+            yield found
+        return
+    for dirpath, dirnames, filenames in os.walk(os.path.join(bag_dir, top)):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            fullpath = os.path.join(dirpath, fname)
+            relpath = os.path.relpath(fullpath, bag_dir)
+            if os.path.sep != '/':
+                relpath = '/'.join(relpath.split(os.path.sep))
+            yield relpath, os.stat(fullpath)
+
+
+def walk(bag_dir, top='data'):
+    # yield (relpath, size) for every file below top
+    for relpath, st in scan(bag_dir, top):
+        yield relpath, st.st_size
+
+
+def interleave(files):
+    """
+    Order (relpath, size) pairs largest, smallest, next largest, next
+    smallest... The big files start early instead of holding up the end of
+    a run, and the small ones fill in around them.
+    """
+    ordered = sorted(files, key=lambda f: f[1], reverse=True)
+    lo, hi = 0, len(ordered) - 1
+    while lo <= hi:
+        yield ordered[lo]
+        lo += 1
+        if lo <= hi:
+            yield ordered[hi]
+            hi -= 1
+
+
+class HashCache(object):
+    """
+    Opt-in SQLite cache of file digests keyed by device, inode, size, mtime
+    and algorithm, so a file that has not been touched is not read again
+    by bag or rebag. Validation never consults it: a fixity check has to
+    read the bytes on disk.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(os.path.dirname(self.path) or '.'):
+            os.makedirs(os.path.dirname(self.path))
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests (dev INTEGER, '
+                        'ino INTEGER, size INTEGER, mtime REAL, '
+                        'algorithm TEXT, digest TEXT, PRIMARY KEY '
+                        '(dev, ino, size, mtime, algorithm))')
+        self.pending = 0
+
+    def _key(self, st, algorithm):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, algorithm)
+
+    def get(self, st, algorithm):
+        row = self.db.execute('SELECT digest FROM digests WHERE dev=? AND '
+                              'ino=? AND size=? AND mtime=? AND algorithm=?',
+                              self._key(st, algorithm)).fetchone()
+        return row[0] if row else None
+
+    def put(self, st, algorithm, digest):
+        self.db.execute('INSERT OR REPLACE INTO digests VALUES '
+                        '(?, ?, ?, ?, ?, ?)',
+                        self._key(st, algorithm) + (digest,))
+        self.pending += 1
+        if self.pending >= 1000:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class Journal(object):
+    """
+    Record of the files already hashed while making a bag, one JSON line
+    each with path, size, mtime and digests, flushed as it is written. If
+    bagging is interrupted the journal, kept as a hidden file in the bag
+    directory, lets make_bag(resume=True) carry on where it stopped.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        if resume:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the line being written when we were stopped
+                        continue
+                    self.entries[entry['path']] = entry
+        self.out = open(self.path, 'a')
+
+    def get(self, relpath, st, algorithms):
+        entry = self.entries.get(relpath)
+        if entry and (entry['size'], entry['mtime']) == (st.st_size,
+                                                         st.st_mtime) \
+                and all(a in entry['digests'] for a in algorithms):
+            return dict((a, entry['digests'][a]) for a in algorithms)
+
+    def record(self, relpath, st, digests):
+        self.out.write(json.dumps({'path': relpath, 'size': st.st_size,
+                                   'mtime': st.st_mtime,
+                                   'digests': digests}) + '\n')
+        self.out.flush()
+
+    def remove(self):
+        self.out.close()
+        os.remove(self.path)
+
+
+class BagProblems(Exception):
+    """
+    Raised with the problems check_bag found, for callers that treat an
+    invalid bag as an error
+    """
+
+    def __init__(self, problems):
+        super(BagProblems, self).__init__('%s problem(s) found' %
+                                          len(problems))
+        self.problems = problems
+
+
+def _unchanged(st, path):
+    now = os.stat(path)
+    return (now.st_size, now.st_mtime) == (st.st_size, st.st_mtime)
+
+
+def hash_files(bag_dir, files, algorithms=('md5',), processes=1,
+                cache=None, journal=None):
+    """
+    Hash (relpath, size) pairs below bag_dir with every algorithm in one
+    read, yielding (relpath, size, {algorithm: digest}) in whatever order
+    they finish. Digests found in journal, a Journal, or cache, a
+    HashCache, are yielded first without reading the file; new ones are
+    added to both.
+    """
+    stats = {}
+    if cache is not None or journal is not None:
+        misses = []
+        for relpath, size in files:
+            st = os.stat(os.path.join(bag_dir, relpath))
+            digests = journal and journal.get(relpath, st, algorithms)
+            if not digests and cache is not None:
+                digests = dict((a, cache.get(st, a)) for a in algorithms)
+                if all(digests.values()) and journal:
+                    journal.record(relpath, st, digests)
+            if digests and all(digests.values()):
+                yield relpath, st.st_size, digests
+            else:
+                stats[relpath] = st
+                misses.append((relpath, size))
+        log.info('%s files hashed before, %s to hash' % (
+            len(files) - len(misses), len(misses)))
+        files = misses
+    tasks = ((relpath, os.path.join(bag_dir, relpath), algorithms)
+             for relpath, size in interleave(files))
+    if processes > 1:
+        pool = Pool(processes=processes)
+        results = pool.imap_unordered(_hash_task, tasks)
+    else:
+        pool = None
+        results = (_hash_task(task) for task in tasks)
+    try:
+        for relpath, size, digests in results:
+            st = stats.pop(relpath, None)
+            # only keep the digests if the file did not change under us
+            if st and _unchanged(st, os.path.join(bag_dir, relpath)):
+                if cache is not None:
+                    for algorithm, digest in digests.items():
+                        cache.put(st, algorithm, digest)
+                if journal is not None:
+                    journal.record(relpath, st, digests)
+            yield relpath, size, digests
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if cache is not None:
+            cache.commit()
+
+
+def _encode_filename(s):
+    # same escaping bagit uses for manifest entries
+    return s.replace('\r', '%0D').replace('\n', '%0A')
+
+
+def _decode_filename(s):
+    return s.replace('%0D', '\r').replace('%0A', '\n')
+
+
+@contextmanager
+def _replace(*paths):
+    """
+    Open a temporary file next to each path for writing and rename them
+    over the paths once they have all been written, so a crash never leaves
+    a half written manifest behind. Yields the file, or a list of files
+    when given several paths.
+    """
+    tmps = [os.path.join(os.path.dirname(path),
+                         '.%s.tmp' % os.path.basename(path))
+            for path in paths]
+    files = []
+    try:
+        for tmp in tmps:
+            files.append(open(tmp, 'w'))
+        yield files[0] if len(files) == 1 else files
+        for f in files:
+            f.close()
+        for tmp, path in zip(tmps, paths):
+            os.rename(tmp, path)
+    finally:
+        for f in files:
+            f.close()
+        for tmp in tmps:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def write_manifests(bag_dir, files, algorithms=('md5',), processes=1,
+                    cache=None, journal=None):
+    """
+    Hash the payload files, reading each once, and stream their lines into
+    a manifest-<alg>.txt per algorithm. Returns the Payload-Oxum
+    ("<bytes>.<files>") of what was hashed.
+    """
+    total_bytes, total_files = 0, 0
+    paths = [os.path.join(bag_dir, 'manifest-%s.txt' % algorithm)
+             for algorithm in algorithms]
+    with _replace(*paths) as out:
+        out = out if len(paths) > 1 else [out]
+        for relpath, size, digests in hash_files(bag_dir, files, algorithms,
+                                                 processes, cache, journal):
+            for algorithm, f in zip(algorithms, out):
+                f.write('%s  %s\n' % (digests[algorithm],
+                                      _encode_filename(relpath)))
+            total_bytes += size
+            total_files += 1
+    return '%s.%s' % (total_bytes, total_files)
+
+
+def write_tag_file(path, tags):
+    with _replace(path) as f:
+        for key in sorted(tags.keys()):
+            f.write('%s: %s\n' % (key, tags[key]))
+
+
+def write_tagmanifests(bag_dir, algorithms=('md5',)):
+    # hash the tag files and write a tagmanifest-<alg>.txt per algorithm
+    lines = dict((algorithm, []) for algorithm in algorithms)
+    for fname in sorted(os.listdir(bag_dir)):
+        fullpath = os.path.join(bag_dir, fname)
+        if fname.startswith('tagmanifest-') or fname.startswith('.') \
+                or not os.path.isfile(fullpath):
+            continue
+        digests, size = hash_file(fullpath, algorithms)
+        for algorithm in algorithms:
+            lines[algorithm].append('%s %s\n' % (digests[algorithm], fname))
+    for algorithm in algorithms:
+        path = os.path.join(bag_dir, 'tagmanifest-%s.txt' % algorithm)
+        with _replace(path) as f:
+            f.writelines(lines[algorithm])
+
+
+def read_tag_file(path):
+    # parse "Label: value" lines, folding indented continuation lines
+    tags = {}
+    key = None
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if line[0] in ' \t' and key:
+                tags[key] += ' ' + line.strip()
+            elif ':' in line:
+                key, value = line.split(':', 1)
+                key = key.strip()
+                tags[key] = value.strip()
+    return tags
+
+
+def read_manifest(path):
+    """
+    Yield (relpath, digest) for each line of a manifest, one line at a time
+    so a manifest with millions of entries is never held in memory
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            digest, relpath = line.split(None, 1)
+            yield _decode_filename(relpath.lstrip('*')), digest.lower()
+
+
+def manifests(bag_dir, prefix='manifest'):
+    # return (algorithm, path) for each of the bag's manifests
+    found = []
+    for path in sorted(glob.glob(os.path.join(bag_dir, '%s-*.txt' % prefix))):
+        name = os.path.basename(path)
+        found.append((name[len(prefix) + 1:-len('.txt')], path))
+    return found
+
+
+def _verify_task(task):
+    # worker side of verify_files, reports IO errors and unsupported
+    # algorithms instead of raising
+    relpath, fullpath, expected = task
+    try:
+        digests, size = hash_file(fullpath, sorted(expected))
+    except (IOError, OSError), e:
+        return relpath, None, expected, None, e.strerror or str(e)
+    except ValueError, e:
+        return relpath, None, expected, None, str(e)
+    return relpath, size, expected, digests, None
+
+
+def _bounded(func, tasks, workers=1, window=None, threads=False):
+    """
+    Run func over tasks with a pool of workers (processes, or threads if
+    threads=True), yielding results in order. Pool.imap reads its whole
+    input up front, so tasks are handed out through apply_async instead
+    and never more than window of them are in flight at once. An
+    exception raised by func is raised again here.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    window = window or workers * 4
+    pool = ThreadPool(workers) if threads else Pool(processes=workers)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def verify_files(bag_dir, entries, processes=1, window=None):
+    """
+    Check (relpath, {algorithm: digest}) entries against the files below
+    bag_dir, reading each file once for all of its algorithms, and
+    yielding (relpath, size, expected, found, error) for each in order
+    """
+    tasks = ((relpath, os.path.join(bag_dir, relpath), expected)
+             for relpath, expected in entries)
+    return _bounded(_verify_task, tasks, processes, window)
+
+
+def _describe(relpath, expected, found, error):
+    if error:
+        return '%s: %s' % (relpath, error)
+    bad = [a for a in sorted(expected) if found.get(a) != expected[a]]
+    if bad:
+        return '%s: %s checksum is %s, expected %s' % (
+            relpath, ', '.join(bad), ', '.join(found[a] for a in bad),
+            ', '.join(expected[a] for a in bad))
+
+
+def stat_files(bag_dir, entries):
+    """
+    Check that (relpath, {algorithm: digest}) entries exist below bag_dir
+    without reading them, yielding the same (relpath, size, expected, found,
+    error) tuples as verify_files with the expected digests passed through
+    as found
+    """
+    for relpath, expected in entries:
+        try:
+            size = os.stat(os.path.join(bag_dir, relpath)).st_size
+        except OSError, e:
+            yield relpath, None, expected, None, e.strerror or str(e)
+            continue
+        yield relpath, size, expected, expected, None
+
+
+class _Lockstep(object):
+    """
+    A manifest streamed alongside another one. Manifests written together
+    list the files in the same order, so pop(relpath) usually finds the
+    next line; lines read past while looking are set aside to be found
+    later, and only those are held in memory.
+    """
+
+    def __init__(self, algorithm, path):
+        self.algorithm = algorithm
+        self._lines = read_manifest(path)
+        self._ahead = {}
+
+    def pop(self, relpath):
+        # the digest for relpath, or None if the manifest doesn't list it
+        if relpath in self._ahead:
+            return self._ahead.pop(relpath)
+        for other, digest in self._lines:
+            if other == relpath:
+                return digest
+            self._ahead[other] = digest
+        return None
+
+    def remaining(self):
+        # the relpaths that were never popped
+        for relpath, digest in self._lines:
+            self._ahead[relpath] = digest
+        return sorted(self._ahead)
+
+
+def _entries(path, algorithm, others=()):
+    """
+    Yield (relpath, {algorithm: digest}) for each line of the manifest at
+    path, adding the digests other manifests, given as _Lockstep readers,
+    have for the same file. Entries are popped from the readers, so
+    whatever remains in them afterwards is in no other manifest.
+    """
+    for relpath, digest in read_manifest(path):
+        expected = {algorithm: digest}
+        for other in others:
+            digest = other.pop(relpath)
+            if digest is not None:
+                expected[other.algorithm] = digest
+        yield relpath, expected
+
+
+def _name_hash(relpath):
+    # adds up to the same total for the same set of names, in any order
+    return int(hashlib.sha1(relpath).hexdigest(), 16)
+
+
+def check_bag(bag_dir, processes=1, fast=False):
+    """
+    Validate a bag, yielding a description of each problem as it is found.
+    The payload is hashed against every manifest in a single read of each
+    file and compared with the Payload-Oxum, the tag files against every
+    tagmanifest. The manifests are streamed and only counts and a checksum
+    of the file names are kept, so memory use does not grow with the bag
+    (the names are only read into memory to report unlisted files);
+    further manifests are read in step with the first, and only lines
+    listed out of order are held.
+
+    With fast=True nothing is hashed: the structure, the presence of every
+    listed file and the Payload-Oxum (total size and file count) are checked
+    from the directory entries alone.
+    """
+    bag_dir = os.path.abspath(bag_dir)
+    for required in ['bagit.txt', 'data']:
+        if not os.path.exists(os.path.join(bag_dir, required)):
+            yield 'missing %s, not a bag' % required
+            return
+    payload = manifests(bag_dir)
+    if not payload:
+        yield 'no payload manifest found'
+        return
+
+    algorithm, path = payload[0]
+    others = [_Lockstep(other, other_path)
+              for other, other_path in payload[1:]]
+    entries = _entries(path, algorithm, others)
+    if fast:
+        log.info('checking files listed in %s' % os.path.basename(path))
+        results = stat_files(bag_dir, entries)
+    else:
+        log.info('checking %s with %s processes' % (
+            ', '.join(os.path.basename(p) for a, p in payload), processes))
+        results = verify_files(bag_dir, entries, processes)
+    # the set of listed files is summed up as a checksum of their names,
+    # and only read again, to name the files, if the payload differs
+    listed = 0
+    for relpath, size, expected, found, error in results:
+        listed = (listed + _name_hash(relpath)) % NAME_HASH_MODULUS
+        for other in others:
+            if other.algorithm not in expected:
+                yield '%s: not in manifest-%s.txt' % (relpath,
+                                                      other.algorithm)
+        problem = _describe(relpath, expected, found, error)
+        if problem:
+            yield problem
+    for other in others:
+        for relpath in other.remaining():
+            yield '%s: in manifest-%s.txt only' % (relpath, other.algorithm)
+
+    on_disk, total_bytes, names = 0, 0, 0
+    for relpath, size in walk(bag_dir):
+        on_disk += 1
+        total_bytes += size
+        names = (names + _name_hash(relpath)) % NAME_HASH_MODULUS
+    if names != listed:
+        in_manifest = set(relpath for relpath, digest in read_manifest(path))
+        for relpath, size in walk(bag_dir):
+            if relpath not in in_manifest:
+                yield '%s: not in manifest-%s.txt' % (relpath, algorithm)
+
+    info_path = os.path.join(bag_dir, 'bag-info.txt')
+    oxum = None
+    if os.path.exists(info_path):
+        oxum = read_tag_file(info_path).get('Payload-Oxum')
+    if oxum and oxum != '%s.%s' % (total_bytes, on_disk):
+        yield 'Payload-Oxum is %s but the payload is %s.%s' % (
+            oxum, total_bytes, on_disk)
+    elif not oxum and fast:
+        yield 'no Payload-Oxum in bag-info.txt to check sizes against'
+
+    for algorithm, path in manifests(bag_dir, 'tagmanifest'):
+        if fast:
+            results = stat_files(bag_dir, _entries(path, algorithm))
+        else:
+            results = verify_files(bag_dir, _entries(path, algorithm))
+        for relpath, size, expected, found, error in results:
+            problem = _describe(relpath, expected, found, error)
+            if problem:
+                yield problem
+
+
+def make_bag(bag_dir, bag_info=None, processes=1, algorithms=('md5',),
+             cache=None, resume=False):
+    """
+    Convert a directory into a bag, like bagit.make_bag, but hashing the
+    payload with a pool of processes worth of workers, reading each file
+    once for all the algorithms, and skipping files whose digests are
+    already in cache. Files are journaled as they are hashed, and with
+    resume=True a run that was interrupted is picked up from its journal.
+    Returns the bagit.Bag and the payload's (relpath, size) pairs.
+    """
+    bag_dir = os.path.abspath(bag_dir)
+    if not os.path.isdir(bag_dir):
+        raise RuntimeError('no such bag directory %s' % bag_dir)
+    journal_path = os.path.join(bag_dir, JOURNAL)
+    if resume:
+        if not os.path.exists(journal_path):
+            raise RuntimeError('no interrupted bag to resume in %s' % bag_dir)
+        log.info('resuming bag for directory %s' % bag_dir)
+    else:
+        log.info('creating bag for directory %s' % bag_dir)
+        # move the contents into data/ through a temporary directory, as
+        # bagit does, so the move never collides with a payload dir "data"
+        temp_data = tempfile.mkdtemp(dir=bag_dir)
+        for fname in os.listdir(bag_dir):
+            fullpath = os.path.join(bag_dir, fname)
+            if fullpath != temp_data:
+                os.rename(fullpath, os.path.join(temp_data, fname))
+        datapath = os.path.join(bag_dir, 'data')
+        os.rename(temp_data, datapath)
+        os.chmod(datapath, os.stat(bag_dir).st_mode)
+    journal = Journal(journal_path, resume)
+
+    log.info('writing %s manifests with %s processes' % (
+        ', '.join(algorithms), processes))
+    files = list(walk(bag_dir))
+    oxum = write_manifests(bag_dir, files, algorithms, processes, cache,
+                           journal)
+    with open(os.path.join(bag_dir, 'bagit.txt'), 'w') as f:
+        f.write(BAGIT_TXT)
+    bag_info = dict(bag_info or {})
+    bag_info.setdefault('Bagging-Date', date.strftime(date.today(),
+                                                      '%Y-%m-%d'))
+    bag_info.setdefault('Bag-Software-Agent', SOFTWARE_AGENT)
+    bag_info['Payload-Oxum'] = oxum
+    write_tag_file(os.path.join(bag_dir, 'bag-info.txt'), bag_info)
+    write_tagmanifests(bag_dir, algorithms)
+    journal.remove()
+    return bagit.Bag(bag_dir), files
+
+
+def update_bag(bag_dir, processes=1, sizes=None, full=False, cache=None):
+    """
+    Bring an existing bag's manifests up to date with its payload, in place
+    in data/, hashing only the files that are new or have changed since the
+    manifests were written. A file counts as changed if it was modified
+    after the oldest manifest, or if sizes (a dict of relpath to size, such
+    as the payload recorded in Inventory) has a different size for it.
+    Checksums of every other file are carried over; with full=True every
+    file is read and hashed again and cache is not used. Each manifest is
+    replaced atomically. Returns a dict of the current (relpath, size)
+    'files' and the relpaths 'added', 'changed' and 'removed'.
+    """
+    bag_dir = os.path.abspath(bag_dir)
+    if not os.path.isdir(os.path.join(bag_dir, 'data')):
+        raise RuntimeError('no data directory in %s' % bag_dir)
+    payload = manifests(bag_dir)
+    algorithms = [algorithm for algorithm, path in payload] or ['md5']
+    if full:
+        files = list(walk(bag_dir))
+        log.info('writing %s manifests with %s processes' % (
+            ', '.join(algorithms), processes))
+        write_manifests(bag_dir, files, algorithms, processes)
+        added, changed, removed = [], files, []
+    else:
+        if not payload:
+            raise RuntimeError('no payload manifest in %s' % bag_dir)
+        since = min(os.path.getmtime(path) for algorithm, path in payload)
+        sizes = sizes or {}
+        old = {}
+        for algorithm, path in payload:
+            old[algorithm] = dict(read_manifest(path))
+        listed = old[payload[0][0]]
+
+        files, added, changed = [], [], []
+        for relpath, st in scan(bag_dir):
+            files.append((relpath, st.st_size))
+            if relpath not in listed:
+                added.append((relpath, st.st_size))
+            elif st.st_mtime >= since or \
+                    sizes.get(relpath, st.st_size) != st.st_size or \
+                    any(relpath not in old[a] for a in algorithms):
+                # a file missing from any manifest is hashed again too
+                changed.append((relpath, st.st_size))
+        current = set(relpath for relpath, size in files)
+        removed = [relpath for relpath in listed if relpath not in current]
+        log.info('%s files added, %s changed and %s removed since %s was '
+                 'written' % (len(added), len(changed), len(removed),
+                              os.path.basename(payload[0][1])))
+
+        for relpath, size, digests in hash_files(bag_dir, added + changed,
+                                                 algorithms, processes,
+                                                 cache):
+            for algorithm in algorithms:
+                old[algorithm][relpath] = digests[algorithm]
+        with _replace(*[path for algorithm, path in payload]) as out:
+            out = out if len(payload) > 1 else [out]
+            for relpath, size in files:
+                for algorithm, f in zip(algorithms, out):
+                    f.write('%s  %s\n' % (old[algorithm][relpath],
+                                          _encode_filename(relpath)))
+
+    if not os.path.exists(os.path.join(bag_dir, 'bagit.txt')):
+        with _replace(os.path.join(bag_dir, 'bagit.txt')) as f:
+            f.write(BAGIT_TXT)
+    info_path = os.path.join(bag_dir, 'bag-info.txt')
+    bag_info = read_tag_file(info_path) if os.path.exists(info_path) else {}
+    bag_info['Payload-Oxum'] = '%s.%s' % (sum(s for r, s in files),
+                                          len(files))
+    write_tag_file(info_path, bag_info)
+    write_tagmanifests(bag_dir, [algorithm for algorithm, path in
+                                 manifests(bag_dir, 'tagmanifest')] or ['md5'])
+    return {'files': files, 'added': [r for r, s in added],
+            'changed': [r for r, s in changed], 'removed': removed}
+
+
+def tee_file(source, targets, algorithms=('md5',), block_size=None,
+             pool=None):
+    """
+    Copy source to every path in targets, reading it once and feeding each
+    block to a hash for each algorithm while it is written. With a thread
+    pool the block is written to the targets in parallel. A target that
+    cannot be written is dropped and the others carry on. Returns a dict of
+    algorithm to hex digest, the size in bytes, and a list with, for each
+    target, None or the error that stopped it.
+    """
+    buf = _buffer(block_size or settings.HASH_BLOCK_SIZE)
+    view = memoryview(buf)
+    checksums = [(algorithm, hashlib.new(algorithm))
+                 for algorithm in algorithms]
+    errors = [None] * len(targets)
+    size = 0
+    with io.open(source, 'rb', buffering=0) as src:
+        dsts = []
+        for i, target in enumerate(targets):
+            try:
+                dsts.append(io.open(target, 'wb'))
+            except (IOError, OSError), e:
+                dsts.append(None)
+                errors[i] = e
+        try:
+            while True:
+                n = src.readinto(buf)
+                if not n:
+                    break
+                live = [i for i, dst in enumerate(dsts) if dst]
+                if pool is not None and len(live) > 1:
+                    # the buffer is only reused once every write is done
+                    writes = [(i, pool.apply_async(dsts[i].write,
+                                                   (view[:n],)))
+                              for i in live]
+                else:
+                    writes = [(i, None) for i in live]
+                for algorithm, checksum in checksums:
+                    checksum.update(view[:n])
+                for i, write in writes:
+                    try:
+                        if write is None:
+                            dsts[i].write(view[:n])
+                        else:
+                            write.get()
+                    except (IOError, OSError), e:
+                        dsts[i].close()
+                        dsts[i], errors[i] = None, e
+                size += n
+        finally:
+            for i, dst in enumerate(dsts):
+                if dst:
+                    try:
+                        dst.close()
+                    except (IOError, OSError), e:
+                        errors[i] = e
+    for i, target in enumerate(targets):
+        if errors[i] is None:
+            try:
+                shutil.copystat(source, target)
+            except (IOError, OSError), e:
+                errors[i] = e
+    return dict((a, c.hexdigest()) for a, c in checksums), size, errors
+
+
+def copy_file(source, target, algorithms=('md5',), block_size=None):
+    """
+    Copy source to target, feeding every block written to a hash for each
+    algorithm, so the copy is checked without reading either file again.
+    Returns a dict of algorithm to hex digest, and the size in bytes.
+    """
+    digests, size, errors = tee_file(source, [target], algorithms,
+                                     block_size)
+    if errors[0] is not None:
+        raise errors[0]
+    return digests, size
+
+
+def _makedirs(path):
+    # several copy threads may create the same directory at once
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _error(e):
+    return getattr(e, 'strerror', None) or str(e)
+
+
+def _copy_task(task):
+    # worker side of replicate_bag, reports IO errors and unsupported
+    # algorithms instead of raising
+    relpath, targets, expected, source_dir, pool = task
+    try:
+        for target_dir in targets:
+            _makedirs(os.path.dirname(os.path.join(target_dir, relpath)))
+    except (IOError, OSError), e:
+        return relpath, None, expected, None, _error(e), []
+    try:
+        digests, size, errors = tee_file(
+            os.path.join(source_dir, relpath),
+            [os.path.join(target_dir, relpath) for target_dir in targets],
+            sorted(expected) or ['md5'], pool=pool)
+    except (IOError, OSError, ValueError), e:
+        return relpath, None, expected, None, _error(e), []
+    return relpath, size, expected, digests, None, \
+        [(target_dir, _error(e)) for target_dir, e in zip(targets, errors)
+         if e is not None]
+
+
+def replicate_bag(source_dir, target_dirs, threads=1, window=None):
+    """
+    Copy a bag to every directory in target_dirs, reading each source file
+    once and writing it to all the targets (in parallel when there are
+    several), with threads files in progress at once. Each file is hashed
+    as it is read and checked against the source's manifests and
+    tagmanifests, as copy_bag does. Yields (target_dir, problem) for each
+    problem as it is found; target_dir is None for a problem with the
+    source, which affects every replica. A target that already exists and
+    is not empty is reported and left alone; the others are still copied.
+    """
+    source_dir = os.path.abspath(source_dir)
+    target_dirs = [os.path.abspath(target_dir) for target_dir in target_dirs]
+    for required in ['bagit.txt', 'data']:
+        if not os.path.exists(os.path.join(source_dir, required)):
+            yield None, 'missing %s, not a bag' % required
+            return
+    for target_dir in list(target_dirs):
+        if os.path.exists(target_dir) and (not os.path.isdir(target_dir)
+                                           or os.listdir(target_dir)):
+            target_dirs.remove(target_dir)
+            yield target_dir, '%s already exists and is not empty' % \
+                target_dir
+    if not target_dirs:
+        return
+    payload = manifests(source_dir)
+    if not payload:
+        yield None, 'no payload manifest found'
+        return
+
+    tags = {}
+    for algorithm, path in manifests(source_dir, 'tagmanifest'):
+        for relpath, digest in read_manifest(path):
+            tags.setdefault(relpath, {})[algorithm] = digest
+    # everything outside data/ is copied too, so a move loses nothing
+    tag_files = []
+    for fname in sorted(os.listdir(source_dir)):
+        fullpath = os.path.join(source_dir, fname)
+        if fname == 'data':
+            continue
+        elif os.path.isdir(fullpath) and not os.path.islink(fullpath):
+            tag_files.extend(relpath for relpath, st in scan(source_dir,
+                                                             fname))
+        elif os.path.isfile(fullpath):
+            tag_files.append(fname)
+        else:
+            yield None, '%s: not a regular file or directory, not ' \
+                'copied' % fname
+    algorithm, path = payload[0]
+    others = [_Lockstep(other, other_path)
+              for other, other_path in payload[1:]]
+
+    # a target that fails is reported once and left out of later files
+    def tasks():
+        for fname in tag_files:
+            yield (fname, list(target_dirs), tags.get(fname, {}), source_dir,
+                   pool)
+        for relpath, expected in _entries(path, algorithm, others):
+            if target_dirs:
+                yield (relpath, list(target_dirs), expected, source_dir,
+                       pool)
+
+    log.info('copying %s to %s with %s threads' % (
+        source_dir, ', '.join(target_dirs), threads))
+    for target_dir in list(target_dirs):
+        try:
+            _makedirs(target_dir)
+        except (IOError, OSError), e:
+            target_dirs.remove(target_dir)
+            yield target_dir, '%s: %s' % (target_dir, _error(e))
+    if not target_dirs:
+        return
+    # writes to the targets, for every file being copied at once
+    pool = ThreadPool(threads * len(target_dirs)) \
+        if len(target_dirs) > 1 else None
+    listed = 0
+    try:
+        for relpath, size, expected, found, error, failed in _bounded(
+                _copy_task, tasks(), threads, window, threads=True):
+            if relpath.startswith('data/'):
+                listed = (listed + _name_hash(relpath)) % NAME_HASH_MODULUS
+                for other in others:
+                    if other.algorithm not in expected:
+                        yield None, '%s: not in manifest-%s.txt' % (
+                            relpath, other.algorithm)
+            problem = _describe(relpath, expected, found, error)
+            if problem:
+                yield None, problem
+            for target_dir, target_error in failed:
+                if target_dir in target_dirs:
+                    target_dirs.remove(target_dir)
+                    yield target_dir, '%s: %s' % (
+                        os.path.join(target_dir, relpath), target_error)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if not target_dirs:
+        return
+    for other in others:
+        for relpath in other.remaining():
+            yield None, '%s: in manifest-%s.txt only, not copied' % (
+                relpath, other.algorithm)
+    names = 0
+    for relpath, size in walk(source_dir):
+        names = (names + _name_hash(relpath)) % NAME_HASH_MODULUS
+    if names != listed:
+        in_manifest = set(relpath for relpath, digest in read_manifest(path))
+        for relpath, size in walk(source_dir):
+            if relpath not in in_manifest:
+                yield None, '%s: not in manifest-%s.txt, not copied' % (
+                    relpath, algorithm)
+
+
+def copy_bag(source_dir, target_dir, threads=1, window=None):
+    """
+    Copy a bag to target_dir with threads parallel streams, hashing each
+    file as it is copied and checking it against the source's manifests
+    and tagmanifests, and yielding a description of each problem as it is
+    found, as check_bag does. A copy that yields no problems is a verified
+    replica: every byte was read once, from the source. Payload files are
+    copied as the first manifest lists them, streamed like check_bag does.
+    """
+    for target, problem in replicate_bag(source_dir, [target_dir], threads,
+                                         window):
+        yield problem
+
+
+def same_device(source, target):
+    # whether target could be reached from source with os.rename
+    parent = os.path.dirname(os.path.abspath(target))
+    while not os.path.exists(parent):
+        parent = os.path.dirname(parent)
+    return os.stat(source).st_dev == os.stat(parent).st_dev
+
+
+def move_bag(source_dir, target_dir, threads=1, window=None, rename=None):
+    """
+    Move a bag to target_dir, yielding a description of each problem as it
+    is found. On the same filesystem the move is one atomic rename and no
+    file is read. Otherwise the bag is copied with copy_bag and the source
+    is only removed once the copy has been verified; if there are problems
+    the partial copy is removed instead and the source left in place.
+    rename says which of the two to do, if the caller already knows.
+    """
+    source_dir = os.path.abspath(source_dir)
+    target_dir = os.path.abspath(target_dir)
+    if os.path.exists(target_dir) and (not os.path.isdir(target_dir)
+                                       or os.listdir(target_dir)):
+        yield '%s already exists and is not empty' % target_dir
+        return
+    if rename is None:
+        rename = same_device(source_dir, target_dir)
+    if rename:
+        log.info('renaming %s to %s' % (source_dir, target_dir))
+        _makedirs(os.path.dirname(target_dir))
+        if os.path.isdir(target_dir):
+            os.rmdir(target_dir)
+        os.rename(source_dir, target_dir)
+        return
+    problems = 0
+    for problem in copy_bag(source_dir, target_dir, threads, window):
+        problems += 1
+        yield problem
+    if problems:
+        if os.path.isdir(target_dir):
+            shutil.rmtree(target_dir)
+        return
+    log.info('copy verified, removing %s' % source_dir)
+    shutil.rmtree(source_dir)
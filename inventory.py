@@ -1,58 +1,578 @@
+from collections import deque, OrderedDict
+import gzip
+import hashlib
+from itertools import izip_longest
 import json
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import tempfile
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
 
 import settings
-from settings import INVENTORY_CREDENTIALS as creds
 
 
 logging.basicConfig(level=settings.LOG_LEVEL)
 log = logging.getLogger('inventory')
 
-baseurl = '%s/api/%s' % (creds['url'], creds['apiversion'])
-auth_header = {'Authorization': 'ApiKey %s:%s' % (creds['user'],
-               creds['apikey']), 'Content-Type': 'application/json'}
 
-# Base HTTP methods
-
-
-def _get(model, pk=None, params={}):
-    params.update({'format': 'json', 'username': creds['user'],
-                   'api_key': creds['apikey']})
-    if pk:
-        url = '%s/%s/%s/' % (baseurl, model, pk)
-    else:
-        url = '%s/%s/' % (baseurl, model)
-    return requests.get(url, params=params, headers=auth_header,
-                        verify=creds['verify_ssl_cert'])
-
-
-def _post(model, **data):
-    # POST is for new items, not changes. Use PUT or PATCH for changes
-    url = '%s/%s/' % (baseurl, model)
-    return requests.post(url, data=json.dumps(data), headers=auth_header,
-                         verify=creds['verify_ssl_cert'])
+class IdentityMap(object):
+    """
+    Objects already handed out by a client, keyed by (model, id), so that
+    every reference to the same object shares one instance and it is
+    fetched at most once. The least recently used entries are dropped once
+    size objects are held; a size of 0 disables the map.
+    """
+
+    def __init__(self, size=None):
+        self.size = settings.INVENTORY_IDENTITY_MAP_SIZE \
+            if size is None else size
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def get(self, model, pk):
+        key = (model, '%s' % pk)
+        with self._lock:
+            obj = self._objects.pop(key, None)
+            if obj is not None:
+                self._objects[key] = obj
+            return obj
+
+    def add(self, model, pk, obj):
+        if not self.size:
+            return
+        key = (model, '%s' % pk)
+        with self._lock:
+            self._objects.pop(key, None)
+            self._objects[key] = obj
+            while len(self._objects) > self.size:
+                self._objects.popitem(last=False)
+
+    def discard(self, model, pk):
+        with self._lock:
+            self._objects.pop((model, '%s' % pk), None)
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+
+class HTTPCache(object):
+    """
+    Opt-in on-disk cache of GET responses, shared by every clint run on a
+    machine. Responses younger than ttl seconds are served without a
+    request; older ones are revalidated with If-None-Match/If-Modified-Since
+    when the server sent an ETag or Last-Modified header. Only single
+    objects of the models listed in settings.INVENTORY_CACHE_MODELS are
+    cached, and writes through the same client drop the cached copy.
+    """
+
+    def __init__(self, path=None, ttl=None, models=None):
+        self.path = path or settings.INVENTORY_CACHE_DIR
+        self.ttl = settings.INVENTORY_CACHE_TTL if ttl is None else ttl
+        self.models = settings.INVENTORY_CACHE_MODELS \
+            if models is None else models
+
+    def _key(self, url, params=None):
+        # the api key is left out so it never ends up on disk
+        query = sorted((k, '%s' % v) for k, v in (params or {}).items()
+                       if k != 'api_key')
+        return hashlib.sha1(json.dumps([url, query])).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], '%s.json' % key)
+
+    def _read(self, key):
+        try:
+            with open(self._file(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, key, entry):
+        fname = self._file(key)
+        if not os.path.isdir(os.path.dirname(fname)):
+            try:
+                os.makedirs(os.path.dirname(fname))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(fname)):
+                    raise
+        tmp = '%s.%s.tmp' % (fname, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, fname)
+
+    def _response(self, entry):
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.url = entry['url']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = 'utf-8'
+        response._content = entry['body'].encode('utf-8')
+        return response
+
+    def get(self, session, url, params, timeout):
+        key = self._key(url, params)
+        entry = self._read(key)
+        if entry and time.time() - entry['stored'] < self.ttl:
+            return self._response(entry)
+        headers = {}
+        if entry and entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry and entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        response = session.get(url, params=params, headers=headers,
+                               timeout=timeout)
+        if response.status_code == 304 and entry:
+            entry['stored'] = time.time()
+            self._write(key, entry)
+            return self._response(entry)
+        elif response.status_code == 200:
+            keep = ['Content-Type', 'ETag', 'Last-Modified']
+            self._write(key, {
+                'url': url, 'status': 200, 'stored': time.time(),
+                'headers': dict((h, response.headers[h]) for h in keep
+                                if h in response.headers),
+                'body': response.content.decode('utf-8')})
+        return response
+
+    def invalidate(self, url, params=None):
+        try:
+            os.remove(self._file(self._key(url, params)))
+        except OSError:
+            pass
+
+    def clear(self):
+        removed = 0
+        for fname in self._files():
+            os.remove(fname)
+            removed += 1
+        return removed
+
+    def _files(self):
+        if not os.path.isdir(self.path):
+            return
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for fname in filenames:
+                if fname.endswith('.json'):
+                    yield os.path.join(dirpath, fname)
+
+    def stats(self):
+        # ages come from when each response was stored or last revalidated,
+        # as get() judges them
+        now = time.time()
+        entries, fresh, size, oldest = 0, 0, 0, None
+        for fname in self._files():
+            entries += 1
+            size += os.path.getsize(fname)
+            try:
+                with open(fname) as f:
+                    age = now - json.load(f)['stored']
+            except (IOError, ValueError, KeyError):
+                continue
+            if age < self.ttl:
+                fresh += 1
+            oldest = age if oldest is None else max(oldest, age)
+        return {'path': self.path, 'ttl': self.ttl, 'entries': entries,
+                'fresh': fresh, 'bytes': size, 'oldest': oldest}
+
+
+class Payload(object):
+    """
+    A bag payload, "relpath size" lines, that is never held in memory as a
+    whole. files is a callable returning (relpath, size) pairs, called
+    again each time the lines are needed. Bag.payload takes one in place of
+    a string and the client streams it into the request body.
+    """
+
+    def __init__(self, files):
+        self.files = files
+
+    def __iter__(self):
+        for relpath, size in self.files():
+            yield '%s %s' % (relpath, size)
 
+    def __str__(self):
+        return '\n'.join(self)
+
+    def __eq__(self, other):
+        if isinstance(other, basestring):
+            other = other.split('\n') if other else []
+        if not isinstance(other, (Payload, list)):
+            return NotImplemented
+        return all(a == b for a, b in izip_longest(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+
+class _Body(object):
+    # a spooled request body; the len attribute gives requests the
+    # Content-Length without asking for a fileno, which would move the
+    # spool from memory to disk
+    def __init__(self, spool):
+        self.spool = spool
+        self.len = spool.tell()
+        spool.seek(0)
+
+    def read(self, size=-1):
+        return self.spool.read(size)
+
+    def __iter__(self):
+        return iter(lambda: self.spool.read(64 * 1024), '')
+
+
+def _write_json(out, data):
+    # json.dump for a flat dict of fields, writing a Payload line by line
+    out.write('{')
+    for i, (key, value) in enumerate(sorted(data.items())):
+        out.write('%s%s: ' % (', ' if i else '', json.dumps(key)))
+        if isinstance(value, Payload):
+            out.write('"')
+            for j, line in enumerate(value):
+                out.write('%s%s' % ('\\n' if j else '',
+                                    json.dumps(line)[1:-1]))
+            out.write('"')
+        else:
+            out.write(json.dumps(value))
+    out.write('}')
+
+
+class InventoryClient(object):
+    """
+    Connection to a single Inventory instance
+
+    Holds the credentials, base url, timeouts, a pooled keep-alive session,
+    an identity map of the objects it has handed out and, if enabled in
+    settings, an on-disk response cache. A client holds no
+    per-request state, so one instance can be shared by worker threads, and
+    several clients (e.g. production and sandbox) can be used side by side
+    in one process.
+    """
+
+    def __init__(self, credentials=None, pool_connections=None,
+                 pool_size=None, max_retries=None, connect_timeout=None,
+                 read_timeout=None, identity_map_size=None, cache=None):
+        if credentials is None:
+            credentials = settings.INVENTORY_CREDENTIALS
+        self.creds = dict(credentials)
+        self.baseurl = '%s/api/%s' % (self.creds['url'],
+                                      self.creds['apiversion'])
+        self.auth_header = {'Authorization': 'ApiKey %s:%s' %
+                            (self.creds['user'], self.creds['apikey']),
+                            'Content-Type': 'application/json'}
+        self.pool_connections = pool_connections or \
+            settings.INVENTORY_POOL_CONNECTIONS
+        self.pool_size = pool_size or settings.INVENTORY_POOL_SIZE
+        self.max_retries = settings.INVENTORY_MAX_RETRIES \
+            if max_retries is None else max_retries
+        self.timeout = (connect_timeout or settings.INVENTORY_CONNECT_TIMEOUT,
+                        read_timeout or settings.INVENTORY_READ_TIMEOUT)
+        self.identity_map = IdentityMap(identity_map_size)
+        # cache=False turns the response cache off, None follows settings
+        if cache is None and settings.INVENTORY_CACHE_DIR:
+            cache = HTTPCache()
+        self.cache = cache or None
+        self.gzip = settings.INVENTORY_GZIP_REQUESTS
+        self._session = None
+        self._lock = threading.Lock()
 
-def _put(model, pk, **data):
-    # PUT changes all fields (overwrites with blank if you don't set a value)
-    # use PATCH to change one or two fields without setting them all
-    url = '%s/%s/%s/' % (baseurl, model, pk)
-    return requests.put(url, data=json.dumps(data), headers=auth_header,
-                        verify=creds['verify_ssl_cert'])
+    def __str__(self):
+        return '<InventoryClient %s>' % self.baseurl
 
+    @property
+    def session(self):
+        # Every call goes through one keep-alive session so that repeated
+        # requests reuse pooled connections instead of paying for a new
+        # TCP/TLS handshake each time
+        with self._lock:
+            if self._session is None:
+                sess = requests.Session()
+                # retry connecting only: a request body is streamed once,
+                # so a request that reached the server is never resent
+                adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                      pool_maxsize=self.pool_size,
+                                      max_retries=Retry(
+                                          total=self.max_retries, read=0))
+                sess.mount('http://', adapter)
+                sess.mount('https://', adapter)
+                sess.headers.update(self.auth_header)
+                sess.verify = self.creds['verify_ssl_cert']
+                self._session = sess
+            return self._session
+
+    def url(self, model, pk=None):
+        if pk:
+            return '%s/%s/%s/' % (self.baseurl, model, pk)
+        return '%s/%s/' % (self.baseurl, model)
+
+    def resource_uri(self, model, pk):
+        # the relative uri the API uses to refer to an object,
+        # such as: /api/v1/item/38989/c01hf854dw/
+        return '/api/%s/%s/%s/' % (self.creds['apiversion'], model, pk)
+
+    def get(self, model, pk=None, params=None):
+        query = dict(params or {})
+        query.update({'format': 'json', 'username': self.creds['user'],
+                      'api_key': self.creds['apikey']})
+        # set/ lookups are not cached, a write could never drop them
+        if self.cache and pk and model in self.cache.models and \
+                not ('%s' % pk).startswith('set/'):
+            return self.cache.get(self.session, self.url(model, pk), query,
+                                  self.timeout)
+        return self.session.get(self.url(model, pk), params=query,
+                                timeout=self.timeout)
+
+    def _invalidate(self, model, pk):
+        self.identity_map.discard(model, pk)
+        if self.cache and model in self.cache.models:
+            self.cache.invalidate(self.url(model, pk),
+                                  {'format': 'json',
+                                   'username': self.creds['user']})
+
+    def _body(self, data):
+        """
+        Encode data as JSON into a spool that stays in memory up to
+        settings.INVENTORY_SPOOL_SIZE bytes and moves to a temporary file
+        beyond that, gzipped if settings.INVENTORY_GZIP_REQUESTS is on, so
+        a bag payload of millions of lines never has to be built as one
+        string. Returns the body and any extra headers.
+        """
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=settings.INVENTORY_SPOOL_SIZE)
+        if self.gzip:
+            out = gzip.GzipFile(fileobj=spool, mode='wb')
+            _write_json(out, data)
+            out.close()
+            return _Body(spool), {'Content-Encoding': 'gzip'}
+        _write_json(spool, data)
+        return _Body(spool), {}
+
+    def post(self, model, **data):
+        # POST is for new items, not changes. Use PUT or PATCH for changes
+        body, headers = self._body(data)
+        return self.session.post(self.url(model), data=body, headers=headers,
+                                 timeout=self.timeout)
+
+    def put(self, model, pk, **data):
+        # PUT changes all fields (overwrites with blank if you don't set a
+        # value) use PATCH to change one or two fields without setting them all
+        self._invalidate(model, pk)
+        body, headers = self._body(data)
+        return self.session.put(self.url(model, pk), data=body,
+                                headers=headers, timeout=self.timeout)
+
+    def patch(self, model, pk, **data):
+        self._invalidate(model, pk)
+        body, headers = self._body(data)
+        return self.session.patch(self.url(model, pk), data=body,
+                                  headers=headers, timeout=self.timeout)
+
+    def delete(self, model, pk):
+        self._invalidate(model, pk)
+        return self.session.delete(self.url(model, pk), timeout=self.timeout)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+# The default client is built on first use from settings.INVENTORY_CREDENTIALS
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = InventoryClient()
+        return _default_client
+
+
+def set_default_client(client):
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
 
-def _patch(model, pk, **data):
-    url = '%s/%s/%s/' % (baseurl, model, pk)
-    return requests.patch(url, data=json.dumps(data), headers=auth_header,
-                          verify=creds['verify_ssl_cert'])
+# Base HTTP methods
 
 
-def _delete(model, pk):
-    url = '%s/%s/%s/' % (baseurl, model, pk)
-    return requests.delete(url, headers=auth_header,
-                           verify=creds['verify_ssl_cert'])
+def _get(model, pk=None, params=None, client=None):
+    return (client or default_client()).get(model, pk, params)
+
+
+def _post(model, client=None, **data):
+    return (client or default_client()).post(model, **data)
+
+
+def _put(model, pk, client=None, **data):
+    return (client or default_client()).put(model, pk, **data)
+
+
+def _patch(model, pk, client=None, **data):
+    return (client or default_client()).patch(model, pk, **data)
+
+
+def _delete(model, pk, client=None):
+    return (client or default_client()).delete(model, pk)
+
+# Paginated reads
+
+
+class _Background(threading.Thread):
+    # Run one call in a daemon thread and hand back its result (or
+    # re-raise its exception) in the caller's thread
+
+    def __init__(self, func, *args, **kwargs):
+        super(_Background, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+def _get_page(client, model, params, offset, page_size, retries=0):
+    query = dict(params)
+    query.update({'offset': offset, 'limit': page_size})
+    attempt = 0
+    while True:
+        try:
+            response = client.get(model, params=query)
+            if response.status_code == 200:
+                return response.json()
+            error = InventoryError(response.text)
+        except requests.RequestException, e:
+            error = e
+        if attempt >= retries:
+            raise error
+        attempt += 1
+        log.warning('retrying %s page at offset %s (%s)' % (model, offset,
+                                                            error))
+        time.sleep(0.5 * 2 ** attempt)
+
+
+def pages(model, params=None, page_size=None, limit=None, prefetch=False,
+          client=None):
+    """
+    Lazily yield each page of a list query as returned by the API
+    ({'meta': ..., 'objects': [...]}), following meta.next until the last
+    page, or until at least limit objects have been fetched. With prefetch
+    the next page is requested in the background while the caller works on
+    the current one.
+    """
+    client = client or default_client()
+    params = dict(params or {})
+    offset = int(params.pop('offset', 0))
+    page_size = params.pop('limit', page_size or settings.INVENTORY_PAGE_SIZE)
+    if limit is not None:
+        page_size = max(1, min(limit, page_size))
+    fetched = 0
+    page = _get_page(client, model, params, offset, page_size)
+    upcoming = None
+    try:
+        while True:
+            meta = page.get('meta', {})
+            fetched += len(page['objects'])
+            more = bool(meta.get('next') and page['objects']) and \
+                (limit is None or fetched < limit)
+            if more:
+                offset = meta.get('offset', offset) + len(page['objects'])
+                if prefetch:
+                    upcoming = _Background(_get_page, client, model, params,
+                                           offset, page_size)
+            yield page
+            if not more:
+                return
+            if upcoming is not None:
+                page, upcoming = upcoming.get(), None
+            else:
+                page = _get_page(client, model, params, offset, page_size)
+    finally:
+        # don't leave a prefetch running if the caller stops early
+        if upcoming is not None:
+            upcoming.join()
+
+
+def iterate(model, params=None, limit=None, page_size=None, prefetch=False,
+            client=None):
+    """
+    Lazily yield objects matching a list query one at a time, across as
+    many pages as needed. Stops after limit objects when one is given.
+    """
+    count = 0
+    for page in pages(model, params, page_size=page_size, limit=limit,
+                      prefetch=prefetch, client=client):
+        for obj in page['objects']:
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            yield obj
+
+
+def fetch_all(model, params=None, page_size=None, concurrency=None,
+              retries=None, client=None):
+    """
+    Yield every page of a list query, in order, fetching them concurrently.
+    The first page gives meta.total_count, from which the remaining page
+    offsets are computed up front and requested by a pool of concurrency
+    threads. At most a couple of pages per thread are held in memory
+    while waiting for the caller. Each page is retried on failure.
+    """
+    client = client or default_client()
+    params = dict(params or {})
+    offset = int(params.pop('offset', 0))
+    page_size = params.pop('limit', page_size or settings.INVENTORY_PAGE_SIZE)
+    concurrency = concurrency or settings.INVENTORY_CONCURRENCY
+    if retries is None:
+        retries = settings.INVENTORY_PAGE_RETRIES
+    first = _get_page(client, model, params, offset, page_size, retries)
+    yield first
+    total = first.get('meta', {}).get('total_count', 0)
+    offsets = deque(range(offset + page_size, total, page_size))
+    if not offsets:
+        return
+    pool = ThreadPool(min(concurrency, len(offsets)))
+    pending = deque()
+    try:
+        while offsets or pending:
+            while offsets and len(pending) < concurrency * 2:
+                pending.append(pool.apply_async(
+                    _get_page, (client, model, params, offsets.popleft(),
+                                page_size, retries)))
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
 
 # helper functions
 
@@ -68,6 +588,96 @@ def parse_id(location, uri=False):
         return '/'.join(uriparts[3:])
 
 
+def _uri_id(uri):
+    # Parse the object id out of a relative resource uri,
+    # such as: /api/v1/item/38989/c01hf854dw/ -> 38989/c01hf854dw
+    return '/'.join(uri.strip('/').split('/')[3:])
+
+
+def _relation_uri(client, model, value):
+    # Build the uri of a related object from its id alone, so saving never
+    # has to load the related object just to refer to it
+    if value is None or value == '':
+        return None
+    elif isinstance(value, basestring):
+        return client.resource_uri(model, value)
+    return client.resource_uri(model, value.id)
+
+
+def _changed(old, new):
+    # Compare two field values, treating a related object as its id
+    def ident(value):
+        if isinstance(value, JSONSerializable):
+            return '%s' % vars(value).get('_%s__id' % value.__class__.__name__)
+        return value
+    return ident(old) != ident(new)
+
+
+def _reference(cls, pk, client):
+    # A lazy reference to a related object. Only the client and id are set,
+    # so reading any other field goes through __getattr__ and loads the
+    # object from Inventory the first time. References are shared through
+    # the client's identity map, so the load happens once per object.
+    model = cls.__name__.lower()
+    obj = client.identity_map.get(model, pk)
+    if obj is None:
+        obj = cls.__new__(cls)
+        object.__setattr__(obj, '_%s__client' % cls.__name__, client)
+        object.__setattr__(obj, '_%s__loaded' % cls.__name__, False)
+        object.__setattr__(obj, '_%s__id' % cls.__name__, pk)
+        client.identity_map.add(model, pk, obj)
+    return obj
+
+
+def _is_loaded(obj):
+    return vars(obj).get('_%s__loaded' % obj.__class__.__name__, False)
+
+
+def _get_many(cls, model, ids, client=None, chunk_size=None):
+    """
+    Fetch many objects of one model in as few requests as possible, using
+    the API's set/ endpoint (/api/v1/<model>/set/id1;id2;.../) for chunks
+    of ids. Objects already loaded in the client's identity map are not
+    fetched again. Related objects are left as lazy references. Returns
+    loaded objects in the order requested, leaving out ids that were not
+    found.
+    """
+    client = client or default_client()
+    chunk_size = chunk_size or settings.INVENTORY_SET_CHUNK_SIZE
+    unique, seen = [], set()
+    for pk in ids:
+        pk = '%s' % pk
+        if pk not in seen:
+            seen.add(pk)
+            unique.append(pk)
+    found = {}
+    known = {}
+    for pk in unique:
+        obj = client.identity_map.get(model, pk)
+        if obj is not None and _is_loaded(obj):
+            known[pk] = obj
+    missing = [pk for pk in unique if pk not in known]
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        response = client.get(model, 'set/%s' % ';'.join(chunk))
+        if response.status_code == 404:
+            continue
+        elif response.status_code != 200:
+            raise InventoryError(response.text)
+        for data in response.json()['objects']:
+            found['%s' % data['id']] = data
+    objects = []
+    for pk in unique:
+        if pk in known:
+            objects.append(known[pk])
+        elif pk in found:
+            # fill in an existing reference rather than make a second copy
+            obj = _reference(cls, found[pk]['id'], client)
+            obj._set_properties(found[pk])
+            objects.append(obj)
+    return objects
+
+
 class Inventory404(Exception):
 
     def __init__(self, msg=''):
@@ -108,7 +718,11 @@ class JSONSerializable(object):
 
     @property
     def as_json(self):
-        return getattr(self, '_data', {})
+        data = getattr(self, '_data', {})
+        if any(isinstance(value, Payload) for value in data.values()):
+            data = dict((key, '%s' % value if isinstance(value, Payload)
+                         else value) for key, value in data.items())
+        return data
 
 
 class Machine(JSONSerializable):
@@ -118,7 +732,8 @@ class Machine(JSONSerializable):
     __relations = []
 
     def __init__(self, id=None, name='', url='', ip='', notes='',
-                 www_root=''):
+                 www_root='', client=None):
+        self.__client = client or default_client()
         self.__loaded = False
         self.__id = id
         self.name = name
@@ -134,9 +749,17 @@ class Machine(JSONSerializable):
         if key in self.__class__.__readonly:
             raise AttributeError("The attribute %s is read-only." % key)
         else:
+            if key in self.__class__.__readwrite and self.__loaded \
+                    and _changed(vars(self).get(key), value):
+                self.__dirty.add(key)
             super(Machine, self).__setattr__(key, value)
 
     def __getattr__(self, key):
+        # a reference knows its id and uri, anything else needs a fetch
+        if key == 'id' and self.__id:
+            return self.__id
+        elif key == 'resource_uri' and self.__id:
+            return self.__client.resource_uri('machine', self.__id)
         if not self.__loaded:
             self._load_properties()
         if key in self.__class__.__readonly:
@@ -145,23 +768,31 @@ class Machine(JSONSerializable):
         else:
             return super(Machine, self).__getattribute__(key)
 
+    @classmethod
+    def get_many(cls, ids, client=None, chunk_size=None):
+        return _get_many(cls, 'machine', ids, client, chunk_size)
+
     def _load_properties(self):
-        response = _get('machine', self.__id)
+        response = self.__client.get('machine', self.__id)
         if response.status_code == 200:
-            self._data = response.json()
-            self.name = self._data['name']
-            self.url = self._data['url']
-            self.ip = self._data['ip']
-            self.notes = self._data['notes']
-            self.www_root = self._data['www_root']
-            self.__resource_uri = self._data['resource_uri']
-            self.__loaded = True
+            self._set_properties(response.json())
         elif response.status_code == 404:
             raise Inventory404('Machine identified by %s not found' %
                                self.__id)
         else:
             raise InventoryError()
 
+    def _set_properties(self, data):
+        self._data = data
+        self.name = self._data['name']
+        self.url = self._data['url']
+        self.ip = self._data['ip']
+        self.notes = self._data['notes']
+        self.www_root = self._data['www_root']
+        self.__resource_uri = self._data['resource_uri']
+        self.__loaded = True
+        self.__dirty = set()
+
     def readwrite(self):
         return self.__readwrite
 
@@ -171,27 +802,32 @@ class Machine(JSONSerializable):
     def save(self):
         """
         Store item in Inventory
-        Do a POST if new (no ID) and PUT otherwise
+        Do a POST if new (no ID), otherwise PATCH the fields that changed
         """
         data = {}
         if not self.__loaded and not self.__id:
             for field in self.__class__.__readwrite:
                 data[field] = getattr(self, field)
-            response = _post('machine', **data)
+            response = self.__client.post('machine', **data)
             if response.status_code == 201:
                 url = response.headers['Location']
-                self.__id = url.rstrip('/').split('/')[-1]
+                self.__id = parse_id(url)
                 return self
             else:
                 raise InventoryError()
         elif self.__loaded:
-            for field in vars(self):
+            # only send the fields that changed since the object was loaded
+            if not self.__dirty:
+                return self
+            for field in self.__dirty:
                 data[field] = getattr(self, field)
-            response = _put('machine', self.id, **data)
-            if response.status_code == 204:
+            response = self.__client.patch('machine', self.__id, **data)
+            if response.status_code in [200, 202, 204]:
+                self._data.update(data)
+                self.__dirty = set()
                 return self
             else:
-                raise InventoryError()
+                raise InventoryError(response.text)
         else:
             return self
 
@@ -215,7 +851,8 @@ class Collection(JSONSerializable):
     __relations = []
 
     def __init__(self, id=None, name='', local_id='', description='', contact_person='',
-                 created=None, access_loc='', stats=None):
+                 created=None, access_loc='', stats=None, client=None):
+        self.__client = client or default_client()
         self.__loaded = False
         self.__id = id
         self.name = name
@@ -233,9 +870,17 @@ class Collection(JSONSerializable):
         if key in self.__class__.__readonly:
             raise AttributeError("The attribute %s is read-only." % key)
         else:
+            if key in self.__class__.__readwrite and self.__loaded \
+                    and _changed(vars(self).get(key), value):
+                self.__dirty.add(key)
             super(Collection, self).__setattr__(key, value)
 
     def __getattr__(self, key):
+        # a reference knows its id and uri, anything else needs a fetch
+        if key == 'id' and self.__id:
+            return self.__id
+        elif key == 'resource_uri' and self.__id:
+            return self.__client.resource_uri('collection', self.__id)
         if not self.__loaded:
             self._load_properties()
         if key in self.__class__.__readonly or key in ['readonly', 'readwrite',
@@ -245,25 +890,33 @@ class Collection(JSONSerializable):
         else:
             return super(Collection, self).__getattribute__(key)
 
+    @classmethod
+    def get_many(cls, ids, client=None, chunk_size=None):
+        return _get_many(cls, 'collection', ids, client, chunk_size)
+
     def _load_properties(self):
-        response = _get('collection', self.__id)
+        response = self.__client.get('collection', self.__id)
         if response.status_code == 200:
-            self._data = response.json()
-            self.name = self._data['name']
-            self.local_id = self._data['local_id']
-            self.description = self._data['description']
-            self.contact_person = self._data['contact_person']
-            self.access_loc = self._data['access_loc']
-            self.__created = self._data['created']
-            self.__stats = self._data['stats']
-            self.__resource_uri = self._data['resource_uri']
-            self.__loaded = True
+            self._set_properties(response.json())
         elif response.status_code == 404:
             raise Inventory404('Collection identified by %s not found' %
                                self.__id)
         else:
             raise InventoryError()
 
+    def _set_properties(self, data):
+        self._data = data
+        self.name = self._data['name']
+        self.local_id = self._data['local_id']
+        self.description = self._data['description']
+        self.contact_person = self._data['contact_person']
+        self.access_loc = self._data['access_loc']
+        self.__created = self._data['created']
+        self.__stats = self._data['stats']
+        self.__resource_uri = self._data['resource_uri']
+        self.__loaded = True
+        self.__dirty = set()
+
     def readwrite(self):
         return self.__readwrite
 
@@ -273,27 +926,32 @@ class Collection(JSONSerializable):
     def save(self):
         """
         Store item in Inventory
-        Do a POST if new (no ID) and PUT otherwise
+        Do a POST if new (no ID), otherwise PATCH the fields that changed
         """
         data = {}
         if not self.__loaded and not self.__id:
             for field in self.__class__.__readwrite:
                 data[field] = getattr(self, field)
-            response = _post('collection', **data)
+            response = self.__client.post('collection', **data)
             if response.status_code == 201:
                 url = response.headers['Location']
-                self.__id = '/'.join(url.rstrip('/').split('/')[-2:])
+                self.__id = parse_id(url)
                 return self
             else:
                 raise InventoryError(response.text)
         elif self.__loaded:
-            for field in vars(self):
+            # only send the fields that changed since the object was loaded
+            if not self.__dirty:
+                return self
+            for field in self.__dirty:
                 data[field] = getattr(self, field)
-            response = _put('collection', self.id, **data)
-            if response.status_code == 204:
+            response = self.__client.patch('collection', self.__id, **data)
+            if response.status_code in [200, 202, 204]:
+                self._data.update(data)
+                self.__dirty = set()
                 return self
             else:
-                raise InventoryError(response)
+                raise InventoryError(response.text)
         else:
             return self
 
@@ -319,7 +977,8 @@ class Project(JSONSerializable):
     __relations = ['collection']
 
     def __init__(self, id=None, name='', created=None, stats=None,
-                 collection=None, start_date='', end_date=''):
+                 collection=None, start_date='', end_date='', client=None):
+        self.__client = client or default_client()
         self.__loaded = False
         self.__id = id
         self.name = name
@@ -337,15 +996,22 @@ class Project(JSONSerializable):
             if value == '':
                 value = None
             elif (isinstance(value, str) or isinstance(value, unicode)):
-                obj = globals()[key.capitalize()](id=value)
-                obj._load_properties()
-                value = obj
+                value = _reference(globals()[key.capitalize()], value,
+                                   self.__client)
         if key in self.__class__.__readonly:
             raise AttributeError("The attribute %s is read-only." % key)
         else:
+            if key in self.__class__.__readwrite and self.__loaded \
+                    and _changed(vars(self).get(key), value):
+                self.__dirty.add(key)
             super(Project, self).__setattr__(key, value)
 
     def __getattr__(self, key):
+        # a reference knows its id and uri, anything else needs a fetch
+        if key == 'id' and self.__id:
+            return self.__id
+        elif key == 'resource_uri' and self.__id:
+            return self.__client.resource_uri('project', self.__id)
         if not self.__loaded:
             self._load_properties()
         if key in self.__class__.__readonly or key in ['readonly', 'readwrite',
@@ -355,27 +1021,36 @@ class Project(JSONSerializable):
         else:
             return super(Project, self).__getattribute__(key)
 
+    @classmethod
+    def get_many(cls, ids, client=None, chunk_size=None):
+        return _get_many(cls, 'project', ids, client, chunk_size)
+
     def _load_properties(self):
-        response = _get('project', self.__id)
+        response = self.__client.get('project', self.__id)
         if response.status_code == 200:
-            self._data = response.json()
-            if self._data['collection']:
-                collection_id = '/'.join(
-                    self._data['collection'].rstrip('/').split('/')[-2:])
-                self.collection = collection_id
-            else:
-                self.__collection = None
-            self.name = self._data['name']
-            self.__created = self._data['created']
-            self.__stats = self._data['stats']
-            self.__resource_uri = self._data['resource_uri']
-            self.__loaded = True
+            self._set_properties(response.json())
         elif response.status_code == 404:
             raise Inventory404('Project identified by %s not found' %
                                self.__id)
         else:
             raise InventoryError()
 
+    def _set_properties(self, data):
+        self._data = data
+        if self._data['collection']:
+            self.collection = _uri_id(self._data['collection'])
+        else:
+            self.__collection = None
+        self.name = self._data['name']
+        self.__created = self._data['created']
+        # set here too, so a lazy reference has them once it is loaded
+        self.start_date = self._data.get('start_date') or ''
+        self.end_date = self._data.get('end_date') or ''
+        self.__stats = self._data['stats']
+        self.__resource_uri = self._data['resource_uri']
+        self.__loaded = True
+        self.__dirty = set()
+
     def readwrite(self):
         return self.__readwrite
 
@@ -385,37 +1060,40 @@ class Project(JSONSerializable):
     def save(self):
         """
         Store item in Inventory
-        Do a POST if new (no ID) and PUT otherwise
+        Do a POST if new (no ID), otherwise PATCH the fields that changed
         """
         data = {}
         if not self.__loaded and not self.__id:
             for field in self.__class__.__readwrite:
                 if field in self.__relations:
-                    try:
-                        data[field] = getattr(self, field).resource_uri
-                    except AttributeError:
-                        data[field] = None
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _post('project', **data)
+            response = self.__client.post('project', **data)
             if response.status_code == 201:
                 url = response.headers['Location']
-                self.__id = '/'.join(url.rstrip('/').split('/')[-2:])
+                self.__id = parse_id(url)
                 return self
             else:
                 raise InventoryError(response.text)
         elif self.__loaded:
-            for field in vars(self):
+            # only send the fields that changed since the object was loaded
+            if not self.__dirty:
+                return self
+            for field in self.__dirty:
                 if field in self.__relations:
-                    relobj = getattr(self, field)
-                    data[field] = relobj.resource_uri if relobj else None
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _put('project', self.id, **data)
-            if response.status_code == 204:
+            response = self.__client.patch('project', self.__id, **data)
+            if response.status_code in [200, 202, 204]:
+                self._data.update(data)
+                self.__dirty = set()
                 return self
             else:
-                raise InventoryError(response)
+                raise InventoryError(response.text)
         else:
             return self
 
@@ -450,7 +1128,8 @@ class Item(JSONSerializable):
 
     def __init__(self, id=None, title='', local_id='', notes='', stats=None,
                  project=None, original_item_type='', created=None,
-                 collection=None, access_loc=''):
+                 collection=None, access_loc='', client=None):
+        self.__client = client or default_client()
         self.__loaded = False
         self.__id = id
         self.title = title
@@ -471,18 +1150,25 @@ class Item(JSONSerializable):
             if value == '':
                 value = None
             elif (isinstance(value, str) or isinstance(value, unicode)):
-                obj = globals()[key.capitalize()](id=value)
-                obj._load_properties()
-                value = obj
+                value = _reference(globals()[key.capitalize()], value,
+                                   self.__client)
         elif key in self.options().keys() \
                 and value in self.options(field=key).values():
             value = self.options(field=key, value=value)
         if key in self.__class__.__readonly:
             raise AttributeError("The attribute %s is read-only." % key)
         else:
+            if key in self.__class__.__readwrite and self.__loaded \
+                    and _changed(vars(self).get(key), value):
+                self.__dirty.add(key)
             super(Item, self).__setattr__(key, value)
 
     def __getattr__(self, key):
+        # a reference knows its id and uri, anything else needs a fetch
+        if key == 'id' and self.__id:
+            return self.__id
+        elif key == 'resource_uri' and self.__id:
+            return self.__client.resource_uri('item', self.__id)
         if not self.__loaded:
             self._load_properties()
         if key in self.__class__.__readonly or key in ['readonly', 'readwrite',
@@ -492,49 +1178,35 @@ class Item(JSONSerializable):
         else:
             return super(Item, self).__getattribute__(key)
 
+    @classmethod
+    def get_many(cls, ids, client=None, chunk_size=None):
+        return _get_many(cls, 'item', ids, client, chunk_size)
+
     def _load_properties(self):
         if self.__id:
-            response = _get('item', self.__id)
+            response = self.__client.get('item', self.__id)
         elif self.local_id:
-            response = _get('item', params={'local_id': self.local_id})
+            response = self.__client.get('item',
+                                         params={'local_id': self.local_id})
         else:
             raise NoIdentifierError()
         if response.status_code == 200:
-            self._data = response.json()
+            data = response.json()
             if not self.__id:
-                if len(self._data['objects']) > 1:
+                if len(data['objects']) > 1:
                     raise NonUniqueIdentifierError(self.local_id)
-                elif len(self._data['objects']) == 0:
+                elif len(data['objects']) == 0:
                     log.debug('no objects')
                     raise Inventory404('Item identified by %s not found' %
                                        self.__id)
                 else:
-                    self._data = self._data['objects'][0]
-                    self.__id = self._data['id']
-            self.title = self._data['title']
-            self.local_id = self._data['local_id']
-            self.notes = self._data['notes']
-            self.__created = self._data['created']
-            if self._data['collection']:
-                collection_id = '/'.join(
-                    self._data['collection'].rstrip('/').split('/')[-2:])
-                self.collection = collection_id
-            else:
-                self.__collection = None
-            if self._data['project']:
-                project_id = '/'.join(
-                    self._data['project'].rstrip('/').split('/')[-2:])
-                self.project = project_id
-            else:
-                self.__project = None
-            self.original_item_type = self._data['original_item_type']
-            self.__stats = self._data['stats']
-            self.__resource_uri = self._data['resource_uri']
-            self.__loaded = True
-            self.access_loc = self._data['access_loc']
+                    data = data['objects'][0]
+                    self.__id = data['id']
+            self._set_properties(data)
         elif response.status_code == 404:
             # try looking up by local id instead
-            if self.__id and not self.local_id:
+            # (vars() so an unloaded reference doesn't recurse into a load)
+            if self.__id and not vars(self).get('local_id'):
                 self.local_id = self.__id
                 self.__id = None
                 self._load_properties()
@@ -544,6 +1216,27 @@ class Item(JSONSerializable):
         else:
             raise InventoryError()
 
+    def _set_properties(self, data):
+        self._data = data
+        self.title = self._data['title']
+        self.local_id = self._data['local_id']
+        self.notes = self._data['notes']
+        self.__created = self._data['created']
+        if self._data['collection']:
+            self.collection = _uri_id(self._data['collection'])
+        else:
+            self.__collection = None
+        if self._data['project']:
+            self.project = _uri_id(self._data['project'])
+        else:
+            self.__project = None
+        self.original_item_type = self._data['original_item_type']
+        self.__stats = self._data['stats']
+        self.__resource_uri = self._data['resource_uri']
+        self.access_loc = self._data['access_loc']
+        self.__loaded = True
+        self.__dirty = set()
+
     def readwrite(self):
         return self.__readwrite
 
@@ -578,38 +1271,40 @@ class Item(JSONSerializable):
     def save(self):
         """
         Store item in Inventory
-        Do a POST if new (no ID) and PUT otherwise
+        Do a POST if new (no ID), otherwise PATCH the fields that changed
         """
         data = {}
         if not self.__loaded and not self.__id:
             for field in self.__class__.__readwrite:
                 if field in self.__relations:
-                    try:
-                        data[field] = getattr(self, field).resource_uri
-                    except AttributeError:
-                        data[field] = None
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _post('item', **data)
+            response = self.__client.post('item', **data)
             if response.status_code == 201:
                 url = response.headers['Location']
-                self.__id = '/'.join(url.rstrip('/').split('/')[-2:])
+                self.__id = parse_id(url)
                 return self
             else:
                 raise InventoryError(response.text)
         elif self.__loaded:
-            for field in vars(self):
+            # only send the fields that changed since the object was loaded
+            if not self.__dirty:
+                return self
+            for field in self.__dirty:
                 if field in self.__relations:
-                    relobj = getattr(self, field)
-                    data[field] = relobj.resource_uri if relobj else None
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _put('item', self.id, **data)
-            if response.status_code == 204:
+            response = self.__client.patch('item', self.__id, **data)
+            if response.status_code in [200, 202, 204]:
+                self._data.update(data)
+                self.__dirty = set()
                 return self
             else:
-                print 'Error with data: %s\n%s' % (data, response.text)
-                raise InventoryError(response)
+                raise InventoryError(response.text)
         else:
             return self
 
@@ -650,7 +1345,8 @@ class Bag(JSONSerializable):
 
     def __init__(self, id=None, bagname=None, created=None, item=None,
                  machine=None, absolute_filesystem_path='', bag_type='',
-                 payload=''):
+                 payload='', client=None):
+        self.__client = client or default_client()
         self.__loaded = False
         self.__id = id
         self.bagname = bagname
@@ -667,18 +1363,25 @@ class Bag(JSONSerializable):
     def __setattr__(self, key, value):
         if key in self.__relations \
                 and (isinstance(value, str) or isinstance(value, unicode)):
-            obj = globals()[key.capitalize()](id=value)
-            obj._load_properties()
-            value = obj
+            value = _reference(globals()[key.capitalize()], value,
+                               self.__client)
         elif key in self.options().keys() \
                 and value in self.options(field=key).values():
             value = self.options(field=key, value=value)
         if key in self.__class__.__readonly:
             raise AttributeError("The attribute %s is read-only." % key)
         else:
+            if key in self.__class__.__readwrite and self.__loaded \
+                    and _changed(vars(self).get(key), value):
+                self.__dirty.add(key)
             super(Bag, self).__setattr__(key, value)
 
     def __getattr__(self, key):
+        # a reference knows its id and uri, anything else needs a fetch
+        if key == 'id' and self.__id:
+            return self.__id
+        elif key == 'resource_uri' and self.__id:
+            return self.__client.resource_uri('bag', self.__id)
         if not self.__loaded:
             self._load_properties()
         if key in self.__class__.__readonly or key in ['readonly', 'readwrite',
@@ -688,57 +1391,70 @@ class Bag(JSONSerializable):
         else:
             return super(Bag, self).__getattribute__(key)
 
+    @classmethod
+    def get_many(cls, ids, client=None, chunk_size=None):
+        return _get_many(cls, 'bag', ids, client, chunk_size)
+
     def _load_properties(self):
-        response = _get('bag', self.__id)
+        response = self.__client.get('bag', self.__id)
         if response.status_code == 200:
-            self._data = response.json()
-            item_id = '/'.join(self._data['item'].rstrip('/').split('/')[-2:])
-            machine_id = '/'.join(self._data['machine'].rstrip('/').split('/')[-1:])
-            self.bagname = self._data['bagname']
-            self.created = self._data['created']
-            self.bag_type = self._data['bag_type']
-            self.item = item_id
-            self.machine = machine_id
-            self.absolute_filesystem_path = self._data['absolute_filesystem_path']
-            self.payload = self._data['payload']
-            self.__resource_uri = self._data['resource_uri']
-            self.__loaded = True
+            self._set_properties(response.json())
         elif response.status_code == 404:
             raise Inventory404('Bag identified by %s not found' %
-                               self.__bagname)
+                               self.__id)
         else:
             raise InventoryError()
 
+    def _set_properties(self, data):
+        self._data = data
+        self.bagname = self._data['bagname']
+        self.created = self._data['created']
+        self.bag_type = self._data['bag_type']
+        self.item = _uri_id(self._data['item'])
+        self.machine = _uri_id(self._data['machine'])
+        self.absolute_filesystem_path = self._data['absolute_filesystem_path']
+        self.payload = self._data['payload']
+        self.__resource_uri = self._data['resource_uri']
+        self.__loaded = True
+        self.__dirty = set()
+
     def save(self):
         """
         Store bag in Inventory
-        Do a POST if new (no ID) and PUT otherwise
+        Do a POST if new (no ID), otherwise PATCH the fields that changed
         """
         data = {}
         if not self.__loaded:
             for field in self.__class__.__readwrite:
                 if field in self.__relations:
-                    data[field] = getattr(self, field).resource_uri
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _post('bag', **data)
+            response = self.__client.post('bag', **data)
             if response.status_code == 201:
                 url = response.headers['Location']
-                self.__id = '/'.join(url.rstrip('/').split('/')[6:])
+                self.__id = parse_id(url)
                 return self
             else:
                 raise InventoryError(response.text)
         elif self.__loaded:
-            for field in vars(self):
+            # only send the fields that changed since the object was loaded
+            if not self.__dirty:
+                return self
+            for field in self.__dirty:
                 if field in self.__relations:
-                    data[field] = getattr(self, field).resource_uri
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _put('bag', self.id, **data)
-            if response.status_code == 204:
+            response = self.__client.patch('bag', self.__id, **data)
+            if response.status_code in [200, 202, 204]:
+                self._data.update(data)
+                self.__dirty = set()
                 return self
             else:
-                raise InventoryError(response)
+                raise InventoryError(response.text)
         else:
             return self
 
@@ -805,7 +1521,9 @@ class BagAction(JSONSerializable):
         }
     }
 
-    def __init__(self, id=None, bag=None, timestamp='', action='', note=''):
+    def __init__(self, id=None, bag=None, timestamp='', action='', note='',
+                 client=None):
+        self.__client = client or default_client()
         self.__loaded = False
         self.__id = id
         self.bag = bag
@@ -819,18 +1537,25 @@ class BagAction(JSONSerializable):
     def __setattr__(self, key, value):
         if key in self.__relations \
                 and (isinstance(value, str) or isinstance(value, unicode)):
-            obj = globals()[key.capitalize()](value)
-            obj._load_properties()
-            value = obj
+            value = _reference(globals()[key.capitalize()], value,
+                               self.__client)
         elif key in self.options().keys() \
                 and value in self.options(field=key).values():
             value = self.options(field=key, value=value)
         if key in self.__class__.__readonly:
             raise AttributeError("The attribute %s is read-only." % key)
         else:
+            if key in self.__class__.__readwrite and self.__loaded \
+                    and _changed(vars(self).get(key), value):
+                self.__dirty.add(key)
             super(BagAction, self).__setattr__(key, value)
 
     def __getattr__(self, key):
+        # a reference knows its id and uri, anything else needs a fetch
+        if key == 'id' and self.__id:
+            return self.__id
+        elif key == 'resource_uri' and self.__id:
+            return self.__client.resource_uri('bagaction', self.__id)
         if not self.__loaded:
             self._load_properties()
         if key in self.__class__.__readonly or key in ['readonly', 'readwrite',
@@ -840,53 +1565,67 @@ class BagAction(JSONSerializable):
         else:
             return super(BagAction, self).__getattribute__(key)
 
+    @classmethod
+    def get_many(cls, ids, client=None, chunk_size=None):
+        return _get_many(cls, 'bagaction', ids, client, chunk_size)
+
     def _load_properties(self):
-        response = _get('bagaction', self.__id)
+        response = self.__client.get('bagaction', self.__id)
         if response.status_code == 200:
-            self._data = response.json()
-            bagname = '/'.join(self._data['bag'].rstrip('/').split('/')[4:])
-            self.bag = bagname
-            self.timestamp = self._data['timestamp']
-            self.action = self._data['action']
-            self.note = self._data['note']
-            self.__resource_uri = self._data['resource_uri']
-            self.__loaded = True
+            self._set_properties(response.json())
         elif response.status_code == 404:
             raise Inventory404('BagAction identified by %s not found' %
                                self.__id)
         else:
             raise InventoryError()
 
+    def _set_properties(self, data):
+        self._data = data
+        self.bag = _uri_id(self._data['bag'])
+        self.timestamp = self._data['timestamp']
+        self.action = self._data['action']
+        self.note = self._data['note']
+        self.__resource_uri = self._data['resource_uri']
+        self.__loaded = True
+        self.__dirty = set()
+
     def save(self):
         """
         Store action in Inventory
-        Do a POST if new (no ID) and PUT otherwise
+        Do a POST if new (no ID), otherwise PATCH the fields that changed
         """
         data = {}
         if not self.__loaded:
             for field in self.__class__.__readwrite:
                 if field in self.__relations:
-                    data[field] = getattr(self, field).resource_uri
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _post('bagaction', **data)
+            response = self.__client.post('bagaction', **data)
             if response.status_code == 201:
                 url = response.headers['Location']
-                self.__id = '/'.join(url.rstrip('/').split('/')[6:])
+                self.__id = parse_id(url)
                 return self
             else:
                 raise InventoryError(response.text)
         elif self.__loaded:
-            for field in vars(self):
+            # only send the fields that changed since the object was loaded
+            if not self.__dirty:
+                return self
+            for field in self.__dirty:
                 if field in self.__relations:
-                    data[field] = getattr(self, field).resource_uri
+                    data[field] = _relation_uri(self.__client, field,
+                                                getattr(self, field))
                 else:
                     data[field] = getattr(self, field)
-            response = _put('bagaction', self.__id, **data)
-            if response.status_code == 204:
+            response = self.__client.patch('bagaction', self.__id, **data)
+            if response.status_code in [200, 202, 204]:
+                self._data.update(data)
+                self.__dirty = set()
                 return self
             else:
-                raise InventoryError(response)
+                raise InventoryError(response.text)
         else:
             return self
 
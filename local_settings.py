@@ -0,0 +1,3 @@
+INVENTORY_CREDENTIALS = {'user': 'u', 'apikey': 'k', 'apiversion': 'v1',
+    'url': 'http://127.0.0.1:8765', 'verify_ssl_cert': False}
+inventory_sandbox = {'user': '', 'apikey': '', 'apiversion': '', 'url': '', 'verify_ssl_cert': False}
@@ -10,6 +10,53 @@ CLINT_INSTALLATION_PATH = ''
 
 FREE_PARTITION_SPACE = 10
 
+# default number of processes used to hash files when bagging
+BAG_PROCESSES = 1
+
+# default number of files copied at once by clint copy
+COPY_THREADS = 4
+
+# checksum algorithms for new bags, all computed in a single read of a file
+BAG_ALGORITHMS = ['md5']
+
+# bytes read from a file at a time while hashing, larger reads suit network
+# filesystems and RAID volumes (e.g. 8 * 1024 * 1024)
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# HTTP connection pooling for requests to Inventory
+# number of hosts to keep pools for, and connections kept alive per host
+INVENTORY_POOL_CONNECTIONS = 4
+INVENTORY_POOL_SIZE = 10
+# retries for connections that could not be made; a request that reached
+# the server (e.g. a PUT whose body was sent) is never retried
+INVENTORY_MAX_RETRIES = 3
+# timeouts in seconds
+INVENTORY_CONNECT_TIMEOUT = 10
+INVENTORY_READ_TIMEOUT = 120
+# number of objects requested per page when listing
+INVENTORY_PAGE_SIZE = 100
+# threads used to fetch pages when listing everything, and retries per page
+INVENTORY_CONCURRENCY = 4
+INVENTORY_PAGE_RETRIES = 2
+# ids per request when fetching many objects at once through set/
+INVENTORY_SET_CHUNK_SIZE = 100
+# objects kept per client so each is fetched at most once per run (0 = off)
+INVENTORY_IDENTITY_MAP_SIZE = 10000
+# on-disk cache of rarely changing objects shared between clint runs
+# set a directory (e.g. os.path.expanduser('~/.clint/cache')) to enable it
+INVENTORY_CACHE_DIR = None
+INVENTORY_CACHE_TTL = 3600
+INVENTORY_CACHE_MODELS = ['machine', 'collection', 'project']
+# request bodies are spooled in memory up to this many bytes, then on disk
+INVENTORY_SPOOL_SIZE = 1024 * 1024
+# gzip request bodies (Content-Encoding: gzip), only if the server or a
+# proxy in front of it decompresses them
+INVENTORY_GZIP_REQUESTS = False
+
+# SQLite cache of file digests used by bag and rebag (never by validate)
+# set a file (e.g. os.path.expanduser('~/.clint/hashes.db')) to enable it
+HASH_CACHE_PATH = None
+
 try:
     from local_settings import *
 except ImportError:
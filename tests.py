@@ -1,6 +1,20 @@
+import gzip
+import json
+import os
+import shutil
+from StringIO import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from unittest import skipIf
 
+import bagit
+import requests
+
+import clint
+import fixity
 import inventory as inv
 from inventory import parse_id, Item, NoIdentifierError, NonUniqueIdentifierError
 import settings
@@ -10,6 +24,51 @@ from settings import inventory_sandbox as sandbox
 settings.INVENTORY_CREDENTIALS = sandbox
 
 
+def _response(status, data=None, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(data) if data is not None else ''
+    response.headers.update(headers or {})
+    return response
+
+
+class FakeClient(inv.InventoryClient):
+    '''
+    A client that answers requests itself instead of sending them. handler
+    is called with (method, model, pk, params or data) and returns the
+    response; every request made is kept in requests.
+    '''
+
+    def __init__(self, handler=None):
+        super(FakeClient, self).__init__({'user': 'tester',
+            'apikey': 'abc123', 'apiversion': 'v1',
+            'url': 'http://127.0.0.1:9', 'verify_ssl_cert': False},
+            cache=False)
+        self.handler = handler or (lambda *request: _response(404))
+        self.requests = []
+        self.requests_lock = threading.Lock()
+
+    def _answer(self, *request):
+        with self.requests_lock:
+            self.requests.append(request)
+        return self.handler(*request)
+
+    def get(self, model, pk=None, params=None):
+        return self._answer('GET', model, pk, params or {})
+
+    def post(self, model, **data):
+        return self._answer('POST', model, None, data)
+
+    def put(self, model, pk, **data):
+        return self._answer('PUT', model, pk, data)
+
+    def patch(self, model, pk, **data):
+        return self._answer('PATCH', model, pk, data)
+
+    def delete(self, model, pk):
+        return self._answer('DELETE', model, pk, {})
+
+
 @skipIf(not all([sandbox.get(k) for k in sandbox.keys() if k != 'verify_ssl_cert']),
     'sandbox inventory not set')
 class TestInventoryHTTPMethods(unittest.TestCase):
@@ -182,5 +241,965 @@ class TestInventoryHTTPMethods(unittest.TestCase):
         inv._delete('item', item.id)
 
 
+class FakeInventory(object):
+    '''
+    A handler for FakeClient that keeps the objects posted to it, so that
+    clint commands can be run against it
+    '''
+
+    def __init__(self):
+        self.objects = {}
+        self.next_id = 100
+
+    def add(self, model, pk, **data):
+        data.update({'id': pk, 'resource_uri': '/api/v1/%s/%s/' % (model,
+                                                                   pk)})
+        self.objects[(model, '%s' % pk)] = data
+
+    def __call__(self, method, model, pk, data):
+        data = dict((k, '%s' % v if isinstance(v, inv.Payload) else v)
+                    for k, v in data.items())
+        if method == 'POST':
+            self.next_id += 1
+            self.add(model, '%s' % self.next_id, **data)
+            return _response(201, headers={'Location':
+                'http://127.0.0.1:9/api/v1/%s/%s/' % (model, self.next_id)})
+        elif (model, pk) not in self.objects:
+            return _response(404)
+        elif method == 'GET':
+            return _response(200, self.objects[(model, pk)])
+        elif method == 'PATCH':
+            self.objects[(model, pk)].update(data)
+            return _response(202)
+        elif method == 'DELETE':
+            del self.objects[(model, pk)]
+            return _response(204)
+        return _response(405)
+
+
+class TestInventoryClient(unittest.TestCase):
+
+    def setUp(self):
+        self.creds = {'user': 'tester', 'apikey': 'abc123', 'apiversion': 'v1',
+            'url': 'http://inventory.example.com', 'verify_ssl_cert': False}
+
+    def test_session_configuration(self):
+        client = inv.InventoryClient(self.creds, pool_connections=2,
+                                     pool_size=8, max_retries=5,
+                                     connect_timeout=3, read_timeout=30)
+        adapter = client.session.get_adapter(client.url('item'))
+        self.assertEqual((adapter._pool_connections, adapter._pool_maxsize),
+                         (2, 8))
+        # connections are retried, reads (a request already sent) are not
+        self.assertEqual((adapter.max_retries.total,
+                          adapter.max_retries.read), (5, 0))
+        self.assertEqual(client.timeout, (3, 30))
+        self.assertIs(client.session, client.session)
+
+    def test_clients_are_independent(self):
+        other = dict(self.creds, url='http://sandbox.example.com', user='sand')
+        client1 = inv.InventoryClient(self.creds)
+        client2 = inv.InventoryClient(other)
+        self.assertEqual(client1.url('item', '1/2'),
+            'http://inventory.example.com/api/v1/item/1/2/')
+        self.assertEqual(client2.url('item'),
+            'http://sandbox.example.com/api/v1/item/')
+        self.assertNotEqual(client1.session, client2.session)
+        self.assertEqual(client2.session.headers['Authorization'],
+            'ApiKey sand:abc123')
+
+    def test_models_use_given_client(self):
+        client = inv.InventoryClient(self.creds)
+        machine = inv.Machine(id='1', client=client)
+        self.assertTrue(machine._Machine__client is client)
+
+    def test_streamed_body(self):
+        client = inv.InventoryClient(self.creds)
+        files = [('data/a "quoted"\tname', 10), ('data/b', 20)]
+        payload = inv.Payload(lambda: files)
+        self.assertEqual(payload, 'data/a "quoted"\tname 10\ndata/b 20')
+        self.assertNotEqual(payload, 'data/b 20')
+        body, headers = client._body({'payload': payload, 'bagname': 'x'})
+        data = body.read()
+        self.assertEqual(body.len, len(data))
+        self.assertEqual(json.loads(data),
+            {'payload': '%s' % payload, 'bagname': 'x'})
+        client.gzip = True
+        body, headers = client._body({'payload': payload})
+        self.assertEqual(headers, {'Content-Encoding': 'gzip'})
+        data = gzip.GzipFile(fileobj=StringIO(body.read())).read()
+        self.assertEqual(json.loads(data), {'payload': '%s' % payload})
+
+    def test_relations_are_lazy(self):
+        # the client points nowhere, so any request would fail
+        client = inv.InventoryClient(dict(self.creds, url='http://127.0.0.1:9'))
+        item = inv.Item(collection='38989/c1', project='38989/p1', client=client)
+        self.assertEqual(item.collection.id, '38989/c1')
+        self.assertEqual(item.project.resource_uri, '/api/v1/project/38989/p1/')
+        self.assertEqual(str(item.collection), '<Collection 38989/c1>')
+
+    def test_resource_uri_inverts_parse_id(self):
+        client = inv.InventoryClient(self.creds)
+        uri = client.resource_uri('item', '38989/c01hf854dw')
+        self.assertEqual(uri, '/api/v1/item/38989/c01hf854dw/')
+        location = 'http://inventory.example.com' + uri
+        self.assertEqual(parse_id(location), '38989/c01hf854dw')
+        self.assertEqual(parse_id(location, uri=True), uri)
+
+
+class TestFetchAll(unittest.TestCase):
+
+    def pages(self, total, fail=None):
+        def handler(method, model, pk, params):
+            if params['offset'] == fail:
+                return _response(500, {'error': 'boom'})
+            ids = range(params['offset'],
+                        min(params['offset'] + params['limit'], total))
+            return _response(200, {'meta': {'total_count': total,
+                                            'offset': params['offset']},
+                                   'objects': [{'id': i} for i in ids]})
+        return FakeClient(handler)
+
+    def test_pages_in_order(self):
+        client = self.pages(95)
+        pages = list(inv.fetch_all('item', page_size=10, concurrency=4,
+                                   client=client))
+        self.assertEqual([obj['id'] for page in pages
+                          for obj in page['objects']], range(95))
+        # a short last page
+        self.assertEqual(len(pages), 10)
+        self.assertEqual(len(pages[-1]['objects']), 5)
+        self.assertEqual(len(client.requests), 10)
+
+    def test_single_page(self):
+        client = self.pages(3)
+        pages = list(inv.fetch_all('item', page_size=10, client=client))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(len(client.requests), 1)
+
+    def test_error_on_middle_page(self):
+        client = self.pages(50, fail=20)
+        pages = inv.fetch_all('item', page_size=10, concurrency=2,
+                              retries=0, client=client)
+        self.assertEqual(len(next(pages)['objects']), 10)
+        self.assertEqual(len(next(pages)['objects']), 10)
+        self.assertRaises(inv.InventoryError, next, pages)
+
+
+class TestPages(unittest.TestCase):
+
+    def pages(self, total):
+        # a list endpoint of total objects that links each page to the next
+        def handler(method, model, pk, params):
+            ids = range(params['offset'],
+                        min(params['offset'] + params['limit'], total))
+            more = params['offset'] + params['limit'] < total
+            return _response(200, {'meta': {'total_count': total,
+                                            'offset': params['offset'],
+                                            'next': '/next/' if more
+                                            else None},
+                                   'objects': [{'id': i} for i in ids]})
+        return FakeClient(handler)
+
+    def test_pages_follow_next(self):
+        for prefetch in [False, True]:
+            client = self.pages(25)
+            pages = list(inv.pages('item', page_size=10, prefetch=prefetch,
+                                   client=client))
+            self.assertEqual([[obj['id'] for obj in page['objects']]
+                              for page in pages],
+                             [range(10), range(10, 20), range(20, 25)])
+            self.assertEqual([r[3]['offset'] for r in client.requests],
+                             [0, 10, 20])
+
+    def test_iterate_limit(self):
+        client = self.pages(100)
+        objects = list(inv.iterate('item', limit=15, page_size=10,
+                                   prefetch=True, client=client))
+        self.assertEqual([obj['id'] for obj in objects], range(15))
+        # the page that reaches the limit is the last one requested
+        self.assertEqual([r[3]['offset'] for r in client.requests], [0, 10])
+
+    def test_prefetch_stops_with_the_caller(self):
+        client = self.pages(100)
+        pages = inv.pages('item', page_size=10, prefetch=True, client=client)
+        next(pages)
+        pages.close()
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if isinstance(thread, inv._Background)])
+        self.assertEqual(len(client.requests), 2)
+
+
+def _machine(pk):
+    return {'id': pk, 'name': 'm%s' % pk, 'url': '', 'ip': '', 'notes': '',
+            'www_root': '', 'resource_uri': '/api/v1/machine/%s/' % pk}
+
+
+class TestGetMany(unittest.TestCase):
+
+    def setUp(self):
+        # machines 1 to 5 exist
+        def handler(method, model, pk, params):
+            ids = [int(i) for i in pk[len('set/'):].split(';')
+                   if int(i) <= 5]
+            if not ids:
+                return _response(404)
+            return _response(200, {'objects': [_machine(i) for i in
+                                               reversed(ids)]})
+        self.client = FakeClient(handler)
+
+    def test_batches_in_order(self):
+        machines = inv.Machine.get_many([3, 1, 2, 1, 4], client=self.client,
+                                        chunk_size=2)
+        self.assertEqual([m.id for m in machines], [3, 1, 2, 4])
+        self.assertEqual([m.name for m in machines], ['m3', 'm1', 'm2', 'm4'])
+        self.assertEqual([r[2] for r in self.client.requests],
+                         ['set/3;1', 'set/2;4'])
+
+    def test_missing_ids(self):
+        machines = inv.Machine.get_many([7, 2, 8, 9], client=self.client,
+                                        chunk_size=2)
+        self.assertEqual([m.id for m in machines], [2])
+        # the chunk of ids that were all missing answered 404
+        self.assertEqual(len(self.client.requests), 2)
+
+    def test_identity_map_reused(self):
+        first = inv.Machine.get_many([1, 2], client=self.client)
+        second = inv.Machine.get_many([2, 1, 3], client=self.client)
+        self.assertTrue(second[0] is first[1])
+        self.assertTrue(second[1] is first[0])
+        self.assertEqual([r[2] for r in self.client.requests],
+                         ['set/1;2', 'set/3'])
+
+
+class FakeSession(object):
+    # answers GETs from a list of responses, keeping the headers sent
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.sent.append(headers)
+        return self.responses.pop(0)
+
+
+class TestHTTPCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = 'http://inventory.example.com/api/v1/machine/1/'
+        self.params = {'format': 'json', 'api_key': 'secret'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fresh_entries_are_served(self):
+        cache = inv.HTTPCache(self.tmpdir, ttl=3600)
+        session = FakeSession(_response(200, {'name': 'm1'}))
+        self.assertEqual(cache.get(session, self.url, self.params,
+                                   None).json(), {'name': 'm1'})
+        self.assertEqual(cache.get(session, self.url, self.params,
+                                   None).json(), {'name': 'm1'})
+        self.assertEqual(len(session.sent), 1)
+        # the api key never ends up on disk
+        for fname in cache._files():
+            self.assertNotIn('secret', open(fname).read())
+
+    def test_revalidation(self):
+        cache = inv.HTTPCache(self.tmpdir, ttl=0)
+        session = FakeSession(
+            _response(200, {'name': 'm1'}, {'ETag': '"v1"'}),
+            _response(304),
+            _response(200, {'name': 'm2'}, {'ETag': '"v2"'}))
+        cache.get(session, self.url, self.params, None)
+        response = cache.get(session, self.url, self.params, None)
+        self.assertEqual(session.sent[1], {'If-None-Match': '"v1"'})
+        self.assertEqual(response.json(), {'name': 'm1'})
+        response = cache.get(session, self.url, self.params, None)
+        self.assertEqual(response.json(), {'name': 'm2'})
+        self.assertEqual(len(session.sent), 3)
+
+    def test_expiry_and_stats(self):
+        cache = inv.HTTPCache(self.tmpdir, ttl=60)
+        session = FakeSession(_response(200, {'name': 'm1'}),
+                              _response(200, {'name': 'm1'}))
+        cache.get(session, self.url, self.params, None)
+        self.assertEqual(cache.stats()['fresh'], 1)
+        # age the entry; its file is rewritten, so only 'stored' is old
+        key = cache._key(self.url, self.params)
+        entry = cache._read(key)
+        entry['stored'] -= 120
+        cache._write(key, entry)
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['fresh']), (1, 0))
+        self.assertTrue(stats['oldest'] >= 120)
+        cache.get(session, self.url, self.params, None)
+        self.assertEqual(len(session.sent), 2)
+
+    def test_invalidate_and_clear(self):
+        cache = inv.HTTPCache(self.tmpdir, ttl=3600)
+        session = FakeSession(*[_response(200, {'name': 'm'})] * 3)
+        cache.get(session, self.url, self.params, None)
+        cache.get(session, self.url + 'x/', self.params, None)
+        cache.invalidate(self.url, self.params)
+        cache.get(session, self.url, self.params, None)
+        self.assertEqual(len(session.sent), 3)
+        self.assertEqual(cache.clear(), 2)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_get_many_after_save(self):
+        class Session(FakeSession):
+            def patch(self, url, data=None, headers=None, timeout=None):
+                return _response(202)
+        client = inv.InventoryClient({'user': 'tester', 'apikey': 'abc123',
+            'apiversion': 'v1', 'url': 'http://127.0.0.1:9',
+            'verify_ssl_cert': False},
+            cache=inv.HTTPCache(self.tmpdir, ttl=3600, models=['machine']))
+        moved = dict(_machine(1), notes='moved to rack 4')
+        client._session = Session(_response(200, {'objects': [_machine(1)]}),
+                                  _response(200, {'objects': [moved]}))
+        machine = inv.Machine.get_many(['1'], client=client)[0]
+        machine.notes = 'moved to rack 4'
+        machine.save()
+        machine = inv.Machine.get_many(['1'], client=client)[0]
+        self.assertEqual(len(client._session.sent), 2)
+        self.assertEqual(machine.notes, 'moved to rack 4')
+
+
+class TestSave(unittest.TestCase):
+
+    def setUp(self):
+        def handler(method, model, pk, data):
+            if method == 'GET':
+                return _response(200, _machine(1))
+            elif method == 'PATCH':
+                return _response(202)
+            return _response(201, headers={
+                'Location': 'http://127.0.0.1:9/api/v1/machine/2/'})
+        self.client = FakeClient(handler)
+
+    def test_unchanged_object_is_not_saved(self):
+        machine = inv.Machine('1', client=self.client)
+        machine._load_properties()
+        machine.name = 'm1'
+        machine.save()
+        self.assertEqual([r[0] for r in self.client.requests], ['GET'])
+
+    def test_only_changed_fields_are_patched(self):
+        machine = inv.Machine('1', client=self.client)
+        machine._load_properties()
+        machine.notes = 'moved to rack 4'
+        machine.save()
+        self.assertEqual(self.client.requests[1],
+                         ('PATCH', 'machine', '1',
+                          {'notes': 'moved to rack 4'}))
+        # once saved, the object is clean again
+        machine.save()
+        self.assertEqual(len(self.client.requests), 2)
+
+    def test_new_object_is_posted(self):
+        machine = inv.Machine(name='m2', url='http://m2', client=self.client)
+        machine.save()
+        method, model, pk, data = self.client.requests[0]
+        self.assertEqual((method, data['name'], data['url']),
+                         ('POST', 'm2', 'http://m2'))
+        self.assertEqual(machine.id, '2')
+
+
+class TestIdentityMap(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        imap = inv.IdentityMap(size=2)
+        imap.add('machine', 1, 'm1')
+        imap.add('machine', 2, 'm2')
+        # touching 1 makes 2 the least recently used
+        self.assertEqual(imap.get('machine', '1'), 'm1')
+        imap.add('machine', 3, 'm3')
+        self.assertEqual(imap.get('machine', 2), None)
+        self.assertEqual(imap.get('machine', 1), 'm1')
+        self.assertEqual(len(imap), 2)
+
+    def test_references_are_shared(self):
+        client = inv.InventoryClient({'user': 'tester', 'apikey': 'abc123',
+            'apiversion': 'v1', 'url': 'http://127.0.0.1:9',
+            'verify_ssl_cert': False})
+        item1 = inv.Item(collection='38989/c1', client=client)
+        item2 = inv.Item(collection='38989/c1', client=client)
+        self.assertTrue(item1.collection is item2.collection)
+        client.identity_map.discard('collection', '38989/c1')
+        item3 = inv.Item(collection='38989/c1', client=client)
+        self.assertFalse(item1.collection is item3.collection)
+
+    def test_references_load_on_first_use(self):
+        client = FakeClient(lambda method, model, pk, params: _response(
+            200, {'id': pk, 'name': 'p1', 'created': '', 'stats': {},
+                  'collection': None, 'start_date': '2014-01-01',
+                  'resource_uri': '/api/v1/project/%s/' % pk}))
+        item = inv.Item(project='p1', client=client)
+        self.assertEqual(client.requests, [])
+        self.assertEqual(item.project.start_date, '2014-01-01')
+        self.assertEqual(item.project.end_date, '')
+        self.assertEqual(len(client.requests), 1)
+
+
+class TestFixity(unittest.TestCase):
+    '''
+    These tests work on a copy of test-data/fakebag
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bagdir = os.path.join(self.tmpdir, 'fakebag')
+        shutil.copytree(os.path.join(os.path.dirname(__file__) or '.',
+            'test-data', 'fakebag'), self.bagdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parallel_make_bag(self):
+        bag, files = fixity.make_bag(self.bagdir, {'Bag-Id': 'test'},
+                                     processes=2)
+        self.assertTrue(bag.is_valid())
+        self.assertEqual(bag.info['Bag-Id'], 'test')
+        self.assertEqual(sorted(bag.payload_files()), ['data/images/1.jpg',
+            'data/images/2.jpg', 'data/metadata/dublincore.xml'])
+        # the payload listing comes back for the Inventory record
+        self.assertEqual(sorted(relpath for relpath, size in files),
+                         sorted(bag.payload_files()))
+
+    def test_check_bag(self):
+        fixity.make_bag(self.bagdir, processes=2)
+        self.assertEqual(list(fixity.check_bag(self.bagdir, processes=2)), [])
+        with open(os.path.join(self.bagdir, 'data', 'images', '1.jpg'),
+                  'a') as f:
+            f.write('x')
+        os.remove(os.path.join(self.bagdir, 'data', 'images', '2.jpg'))
+        problems = list(fixity.check_bag(self.bagdir, processes=2))
+        self.assertEqual(len(problems), 3)
+        self.assertTrue(problems[0].startswith('data/images/'))
+        self.assertTrue(problems[2].startswith('Payload-Oxum'))
+
+    def test_unlisted_files_are_named(self):
+        fixity.make_bag(self.bagdir)
+        # one file missing and one unlisted keep the count the same
+        os.remove(os.path.join(self.bagdir, 'data', 'images', '2.jpg'))
+        with open(os.path.join(self.bagdir, 'data', 'extra.txt'), 'w') as f:
+            f.write('x')
+        problems = list(fixity.check_bag(self.bagdir))
+        self.assertTrue(problems[0].startswith('data/images/2.jpg'))
+        self.assertIn('data/extra.txt: not in manifest-md5.txt', problems)
+
+    def test_check_bag_fast(self):
+        xml = os.path.join(self.bagdir, 'metadata', 'dublincore.xml')
+        with open(xml, 'w') as f:
+            f.write('<dc/>')
+        fixity.make_bag(self.bagdir)
+        self.assertEqual(list(fixity.check_bag(self.bagdir, fast=True)), [])
+        # a same-size change passes the fast check but not the full one
+        with open(os.path.join(self.bagdir, 'data', 'metadata',
+                               'dublincore.xml'), 'w') as f:
+            f.write('<DC/>')
+        self.assertEqual(list(fixity.check_bag(self.bagdir, fast=True)), [])
+        self.assertEqual(len(list(fixity.check_bag(self.bagdir))), 1)
+        os.remove(os.path.join(self.bagdir, 'data', 'images', '1.jpg'))
+        problems = list(fixity.check_bag(self.bagdir, fast=True))
+        self.assertTrue(problems[0].startswith('data/images/1.jpg'))
+
+    def test_update_bag(self):
+        fixity.make_bag(self.bagdir)
+        manifest = os.path.join(self.bagdir, 'manifest-md5.txt')
+        # backdate the manifest so the payload looks modified after it
+        os.utime(manifest, (0, 0))
+        result = fixity.update_bag(self.bagdir)
+        self.assertEqual(len(result['changed']), 3)
+        with open(os.path.join(self.bagdir, 'data', 'new.txt'), 'w') as f:
+            f.write('new')
+        os.remove(os.path.join(self.bagdir, 'data', 'images', '1.jpg'))
+        result = fixity.update_bag(self.bagdir,
+            sizes={'data/images/2.jpg': 10})
+        self.assertEqual(result['added'], ['data/new.txt'])
+        self.assertEqual(result['changed'], ['data/images/2.jpg'])
+        self.assertEqual(result['removed'], ['data/images/1.jpg'])
+        self.assertEqual(list(fixity.check_bag(self.bagdir)), [])
+
+    def test_update_bag_full(self):
+        fixity.make_bag(self.bagdir)
+        with open(os.path.join(self.bagdir, 'data', 'new.txt'), 'w') as f:
+            f.write('new')
+        result = fixity.update_bag(self.bagdir, full=True)
+        self.assertEqual(len(result['changed']), 4)
+        self.assertEqual(sorted(os.listdir(self.bagdir)), ['bag-info.txt',
+            'bagit.txt', 'data', 'manifest-md5.txt', 'tagmanifest-md5.txt'])
+        self.assertEqual(list(fixity.check_bag(self.bagdir)), [])
+
+    def test_hash_cache(self):
+        # an mtime after the manifests are written, so rebag looks again
+        mtime = int(time.time()) + 3600
+        xml = os.path.join(self.bagdir, 'metadata', 'dublincore.xml')
+        with open(xml, 'w') as f:
+            f.write('<dc/>')
+        os.utime(xml, (mtime, mtime))
+        cache = fixity.HashCache(os.path.join(self.tmpdir, 'hashes.db'))
+        fixity.make_bag(self.bagdir, cache=cache)
+        # same size and mtime, so the cached digest is trusted by rebag...
+        xml = os.path.join(self.bagdir, 'data', 'metadata', 'dublincore.xml')
+        with open(xml, 'w') as f:
+            f.write('<DC/>')
+        os.utime(xml, (mtime, mtime))
+        result = fixity.update_bag(self.bagdir, cache=cache)
+        self.assertEqual(result['changed'], ['data/metadata/dublincore.xml'])
+        # ...but not by validate
+        problems = list(fixity.check_bag(self.bagdir))
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith('data/metadata/dublincore'))
+        # nor by a full rebag, which reads every file
+        fixity.update_bag(self.bagdir, full=True, cache=cache)
+        cache.close()
+        self.assertEqual(list(fixity.check_bag(self.bagdir)), [])
+
+    def test_multiple_algorithms(self):
+        bag, files = fixity.make_bag(self.bagdir, processes=2,
+                                     algorithms=['md5', 'sha256'])
+        self.assertTrue(bag.is_valid())
+        self.assertEqual(sorted(set(bag.algs)), ['md5', 'sha256'])
+        self.assertEqual(list(fixity.check_bag(self.bagdir, processes=2)), [])
+        with open(os.path.join(self.bagdir, 'data', 'images', '1.jpg'),
+                  'w') as f:
+            f.write('x')
+        fixity.update_bag(self.bagdir)
+        self.assertTrue(bagit.Bag(self.bagdir).is_valid())
+
+    def test_manifests_out_of_step(self):
+        fixity.make_bag(self.bagdir, algorithms=['md5', 'sha1'])
+        sha1 = os.path.join(self.bagdir, 'manifest-sha1.txt')
+        lines = open(sha1).readlines()
+        # listed in a different order from manifest-md5.txt
+        with open(sha1, 'w') as f:
+            f.writelines(reversed(lines))
+        fixity.write_tagmanifests(self.bagdir, ['md5', 'sha1'])
+        self.assertEqual(list(fixity.check_bag(self.bagdir)), [])
+        # a file missing from one manifest, another only in it
+        with open(sha1, 'w') as f:
+            f.writelines(lines[1:] + ['abc  data/extra\n'])
+        fixity.write_tagmanifests(self.bagdir, ['md5', 'sha1'])
+        missing = lines[0].split(None, 1)[1].strip()
+        self.assertEqual(list(fixity.check_bag(self.bagdir)), [
+            '%s: not in manifest-sha1.txt' % missing,
+            'data/extra: in manifest-sha1.txt only'])
+        # rebag hashes the missing file again rather than failing
+        with open(sha1, 'w') as f:
+            f.writelines(lines[1:])
+        result = fixity.update_bag(self.bagdir)
+        self.assertEqual(result['changed'], [missing])
+        self.assertEqual(list(fixity.check_bag(self.bagdir)), [])
+
+    def test_resume_make_bag(self):
+        # the state bagging leaves behind if it is stopped after hashing
+        # one file: the payload already moved into data/ and a journal
+        os.rename(self.bagdir, self.bagdir + '-data')
+        os.mkdir(self.bagdir)
+        os.rename(self.bagdir + '-data', os.path.join(self.bagdir, 'data'))
+        st = os.stat(os.path.join(self.bagdir, 'data', 'images', '1.jpg'))
+        journal = fixity.Journal(os.path.join(self.bagdir, fixity.JOURNAL))
+        journal.record('data/images/1.jpg', st, {'md5': 'journaled'})
+        journal.out.close()
+        fixity.make_bag(self.bagdir, resume=True)
+        self.assertFalse(os.path.exists(os.path.join(self.bagdir,
+                                                     fixity.JOURNAL)))
+        manifest = dict(fixity.read_manifest(os.path.join(self.bagdir,
+                                                          'manifest-md5.txt')))
+        self.assertEqual(len(manifest), 3)
+        self.assertEqual(manifest['data/images/1.jpg'], 'journaled')
+
+    def test_copy_bag(self):
+        xml = os.path.join(self.bagdir, 'metadata', 'dublincore.xml')
+        with open(xml, 'w') as f:
+            f.write('<dc/>')
+        fixity.make_bag(self.bagdir, algorithms=['md5', 'sha1'])
+        target = os.path.join(self.tmpdir, 'copy')
+        self.assertEqual(list(fixity.copy_bag(self.bagdir, target,
+                                              threads=2)), [])
+        self.assertTrue(bagit.Bag(target).is_valid())
+        self.assertEqual(list(fixity.copy_bag(self.bagdir, target)),
+                         ['%s already exists and is not empty' % target])
+        # a source file that no longer matches its manifest is caught
+        with open(os.path.join(self.bagdir, 'data', 'metadata',
+                               'dublincore.xml'), 'w') as f:
+            f.write('<DC/>')
+        problems = list(fixity.copy_bag(self.bagdir, target + '2'))
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith(
+            'data/metadata/dublincore.xml: md5, sha1 checksum'))
+
+    def test_replicate_bag(self):
+        fixity.make_bag(self.bagdir, algorithms=['md5', 'sha1'])
+        targets = [os.path.join(self.tmpdir, 'r1'),
+                   os.path.join(self.tmpdir, 'r2')]
+        self.assertEqual(list(fixity.replicate_bag(self.bagdir, targets,
+                                                   threads=2)), [])
+        for target in targets:
+            self.assertTrue(bagit.Bag(target).is_valid())
+        # a target that cannot be written fails alone
+        blocker = os.path.join(self.tmpdir, 'file')
+        open(blocker, 'w').close()
+        bad = os.path.join(blocker, 'r3')
+        good = os.path.join(self.tmpdir, 'r4')
+        problems = list(fixity.replicate_bag(self.bagdir, [bad, good]))
+        self.assertEqual([target for target, problem in problems], [bad])
+        self.assertTrue(bagit.Bag(good).is_valid())
+
+    def test_worker_errors_do_not_hang(self):
+        fixity.make_bag(self.bagdir)
+        with open(os.path.join(self.bagdir, 'manifest-foo.txt'), 'w') as f:
+            f.write('abc  data/images/1.jpg\n')
+        problems = list(fixity.check_bag(self.bagdir, processes=2))
+        self.assertTrue(any('unsupported hash type' in problem
+                            for problem in problems))
+        target = os.path.join(self.tmpdir, 'copy')
+        problems = list(fixity.copy_bag(self.bagdir, target, threads=2))
+        self.assertTrue(any('unsupported hash type' in problem
+                            for problem in problems))
+        # anything else a worker raises reaches the caller
+        def fail(task):
+            raise RuntimeError(task)
+        self.assertRaises(RuntimeError, list,
+                          fixity._bounded(fail, range(10), 2, threads=True))
+
+    def test_move_bag(self):
+        fixity.make_bag(self.bagdir)
+        inode = os.stat(self.bagdir).st_ino
+        target = os.path.join(self.tmpdir, 'moved', 'fakebag')
+        self.assertTrue(fixity.same_device(self.bagdir, target))
+        self.assertEqual(list(fixity.move_bag(self.bagdir, target)), [])
+        self.assertFalse(os.path.exists(self.bagdir))
+        # a rename, not a copy
+        self.assertEqual(os.stat(target).st_ino, inode)
+        self.assertTrue(bagit.Bag(target).is_valid())
+
+    def test_move_bag_by_copy(self):
+        fixity.make_bag(self.bagdir)
+        target = os.path.join(self.tmpdir, 'moved', 'fakebag')
+        same_device = fixity.same_device
+        fixity.same_device = lambda source, target: False
+        try:
+            # a source that no longer matches its manifest is not moved
+            jpg = os.path.join(self.bagdir, 'data', 'images', '1.jpg')
+            original = open(jpg, 'rb').read()
+            with open(jpg, 'wb') as f:
+                f.write('x')
+            problems = list(fixity.move_bag(self.bagdir, target))
+            self.assertEqual(len(problems), 1)
+            self.assertFalse(os.path.exists(target))
+            self.assertTrue(os.path.exists(self.bagdir))
+            with open(jpg, 'wb') as f:
+                f.write(original)
+            inode = os.stat(self.bagdir).st_ino
+            self.assertEqual(list(fixity.move_bag(self.bagdir, target)), [])
+        finally:
+            fixity.same_device = same_device
+        self.assertFalse(os.path.exists(self.bagdir))
+        self.assertNotEqual(os.stat(target).st_ino, inode)
+        self.assertTrue(bagit.Bag(target).is_valid())
+
+    def test_move_bag_with_tag_directories(self):
+        fixity.make_bag(self.bagdir)
+        os.mkdir(os.path.join(self.bagdir, 'metadata'))
+        with open(os.path.join(self.bagdir, 'metadata', 'mods.xml'),
+                  'w') as f:
+            f.write('<mods/>')
+        with open(os.path.join(self.bagdir, '.keep'), 'w') as f:
+            f.write('keep')
+        target = os.path.join(self.tmpdir, 'moved', 'fakebag')
+        same_device = fixity.same_device
+        fixity.same_device = lambda source, target: False
+        try:
+            self.assertEqual(list(fixity.move_bag(self.bagdir, target)), [])
+        finally:
+            fixity.same_device = same_device
+        self.assertFalse(os.path.exists(self.bagdir))
+        with open(os.path.join(target, 'metadata', 'mods.xml')) as f:
+            self.assertEqual(f.read(), '<mods/>')
+        with open(os.path.join(target, '.keep')) as f:
+            self.assertEqual(f.read(), 'keep')
+        self.assertTrue(bagit.Bag(target).is_valid())
+
+    def test_interleave(self):
+        files = [('a', 1), ('b', 5), ('c', 3), ('d', 4), ('e', 2)]
+        self.assertEqual([f[0] for f in fixity.interleave(files)],
+            ['b', 'a', 'd', 'e', 'c'])
+
+
+class TestCommands(unittest.TestCase):
+    '''
+    These tests run clint commands against a FakeInventory
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bagdir = os.path.join(self.tmpdir, 'fakebag')
+        shutil.copytree(os.path.join(os.path.dirname(__file__) or '.',
+            'test-data', 'fakebag'), self.bagdir)
+        self.inventory = FakeInventory()
+        self.client = FakeClient(self.inventory)
+        self.default_client = inv.default_client()
+        inv.set_default_client(self.client)
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        inv.set_default_client(self.default_client)
+        shutil.rmtree(self.tmpdir)
+
+    def run_command(self, *argv):
+        args = clint.make_parser().parse_args(argv)
+        args.func(args)
+
+    def add_bag(self, pk, path, payload=''):
+        self.inventory.add('bag', pk, bagname='b%s' % pk, created='',
+            bag_type='2', item='/api/v1/item/38989/i1/',
+            machine='/api/v1/machine/1/', absolute_filesystem_path=path,
+            payload=payload)
+
+    def test_bag_with_another_name(self):
+        walks = []
+        walk = fixity.walk
+
+        def counted(*args, **kwargs):
+            walks.append(args)
+            return walk(*args, **kwargs)
+        fixity.walk = counted
+        try:
+            self.run_command('--no-cache', 'bag', self.bagdir, '-n', 'renamed',
+                             '-t', 'Preservation', '-m', '1', '-i', '38989/i1')
+        finally:
+            fixity.walk = walk
+        renamed = os.path.join(self.tmpdir, 'renamed')
+        self.assertFalse(os.path.exists(self.bagdir))
+        self.assertTrue(bagit.Bag(renamed).is_valid())
+        posted = [r[3] for r in self.client.requests
+                  if r[:2] == ('POST', 'bag')]
+        self.assertEqual(len(posted), 1)
+        self.assertEqual(sorted(line.rsplit(' ', 1)[0] for line in
+                                posted[0]['payload']),
+                         ['data/images/1.jpg', 'data/images/2.jpg',
+                          'data/metadata/dublincore.xml'])
+        # the payload came from the listing made while hashing
+        self.assertEqual(len(walks), 1)
+
+    def test_bag_with_a_payload(self):
+        self.run_command('--no-cache', 'bag', self.bagdir, '-t',
+                         'Preservation', '-m', '1', '-i', '38989/i1', '-y',
+                         'data/all.tar 1024')
+        posted = [r[3] for r in self.client.requests
+                  if r[:2] == ('POST', 'bag')]
+        self.assertEqual(posted[0]['payload'], 'data/all.tar 1024')
+
+    def test_move_by_bag_name(self):
+        # no Bag-Id in bag-info.txt, so the bag is found by its name
+        fixity.make_bag(self.bagdir)
+        self.add_bag('fakebag', self.bagdir)
+        target = os.path.join(self.tmpdir, 'moved', 'fakebag')
+        self.run_command('move', self.bagdir, target)
+        self.assertEqual(self.inventory.objects[('bag', 'fakebag')]
+                         ['absolute_filesystem_path'], target)
+        self.assertEqual(self.client.requests[-1][:2], ('POST', 'bagaction'))
+
+    def test_move_reports_new_path_if_not_saved(self):
+        fixity.make_bag(self.bagdir, {'Bag-Id': '5'})
+        self.add_bag('5', self.bagdir)
+        inventory = self.client.handler
+        self.client.handler = lambda method, *request: _response(500) \
+            if method == 'PATCH' else inventory(method, *request)
+        target = os.path.join(self.tmpdir, 'moved')
+        with self.assertRaises(SystemExit) as cm:
+            self.run_command('move', self.bagdir, target)
+        self.assertIn('Bag moved to %s' % target, cm.exception.code)
+        self.assertIn('clint edit bag 5 -p %s' % target, cm.exception.code)
+        self.assertTrue(bagit.Bag(target).is_valid())
+
+    def test_list_limit_and_all(self):
+        def handler(method, model, pk, params):
+            ids = range(params['offset'],
+                        min(params['offset'] + params['limit'], 130))
+            more = params['offset'] + params['limit'] < 130
+            return _response(200, {'meta': {'total_count': 130,
+                                            'offset': params['offset'],
+                                            'next': '/next/' if more
+                                            else None},
+                                   'objects': [{'id': i, 'name': 'c%s' % i}
+                                               for i in ids]})
+        self.client.handler = handler
+        self.run_command('list', 'collection', '--limit', '5')
+        self.assertIn('5 collections listed', sys.stdout.getvalue())
+        self.assertEqual([r[3]['limit'] for r in self.client.requests], [5])
+        sys.stdout = StringIO()
+        self.client.requests = []
+        self.run_command('list', 'collection', '--all', '--concurrency', '1')
+        self.assertIn('130 collections listed', sys.stdout.getvalue())
+        self.assertEqual([r[3]['offset'] for r in self.client.requests],
+                         [0, 100])
+
+    def test_import(self):
+        fixity.make_bag(self.bagdir)
+        bad = os.path.join(self.tmpdir, 'bad')
+        shutil.copytree(self.bagdir, bad)
+        with open(os.path.join(bad, 'data', 'images', '1.jpg'), 'w') as f:
+            f.write('x')
+        rows = os.path.join(self.tmpdir, 'items.csv')
+        with open(rows, 'w') as f:
+            f.write('Item Name,Local ID,Collection ID,Item Type,Bag Type,'
+                    'Bag Path,Machine ID,Bag Name,Item Notes,'
+                    'Item Access Location\n')
+            for name, path in [('good', self.bagdir), ('bad', bad),
+                               ('none', os.path.join(self.tmpdir, 'none'))]:
+                f.write('%s,L-%s,38989/c1,1,2,%s,1,%s,,\n' % (name, name,
+                                                             path, name))
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                self.run_command('import', rows, '--concurrency', '2')
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn('row 3 (bad): Bag is NOT valid', errors)
+        self.assertIn('row 4 (none): Expected bagit.txt does not exist',
+                      errors)
+        self.assertIn('1 of 3 rows imported', sys.stdout.getvalue())
+        # only the row that validated was registered
+        posted = [r[1] for r in self.client.requests if r[0] == 'POST']
+        self.assertEqual(sorted(posted),
+                         ['bag', 'bagaction', 'bagaction', 'item'])
+        items = [data for (model, pk), data in self.inventory.objects.items()
+                 if model == 'item']
+        self.assertEqual([item['title'] for item in items], ['good'])
+
+    def test_import_failure_is_undone(self):
+        fixity.make_bag(self.bagdir)
+        rows = os.path.join(self.tmpdir, 'items.csv')
+        with open(rows, 'w') as f:
+            f.write('Item Name,Local ID,Collection ID,Item Type,Bag Type,'
+                    'Bag Path,Machine ID,Bag Name,Item Notes,'
+                    'Item Access Location\n'
+                    'good,L-1,38989/c1,1,2,%s,1,good,,\n' % self.bagdir)
+
+        def handler(method, model, pk, data):
+            if method == 'POST' and model == 'bagaction':
+                return _response(500)
+            return self.inventory(method, model, pk, data)
+        self.client.handler = handler
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                self.run_command('import', rows)
+        finally:
+            sys.stderr = stderr
+        # the item and bag saved before the failure are gone again
+        self.assertEqual([r[:2] for r in self.client.requests
+                          if r[0] == 'DELETE'],
+                         [('DELETE', 'bag'), ('DELETE', 'item')])
+        self.assertEqual(self.inventory.objects, {})
+
+    def test_replicate(self):
+        fixity.make_bag(self.bagdir, {'Bag-Id': '5'})
+        self.add_bag('5', self.bagdir)
+        busy = os.path.join(self.tmpdir, 'busy')
+        os.mkdir(busy)
+        open(os.path.join(busy, 'other'), 'w').close()
+        fresh = os.path.join(self.tmpdir, 'fresh')
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                self.run_command('replicate', self.bagdir, '--target',
+                                 '2:%s' % busy, '--target', '3:%s' % fresh)
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn('Replica %s failed' % busy, errors)
+        self.assertEqual(os.listdir(busy), ['other'])
+        # the empty target was still copied, and registered on its machine
+        self.assertTrue(bagit.Bag(fresh).is_valid())
+        posted = [r[3] for r in self.client.requests
+                  if r[:2] == ('POST', 'bag')]
+        self.assertEqual([(data['absolute_filesystem_path'], data['machine'])
+                          for data in posted],
+                         [(fresh, '/api/v1/machine/3/')])
+        info = fixity.read_tag_file(os.path.join(fresh, 'bag-info.txt'))
+        self.assertNotEqual(info['Bag-Id'], '5')
+
+    def test_rebag_skips_malformed_payload_lines(self):
+        fixity.make_bag(self.bagdir, {'Bag-Id': '5'})
+        with open(os.path.join(self.bagdir, 'data', 'new'), 'w') as f:
+            f.write('new')
+        self.add_bag('5', self.bagdir, 'data/images/1.jpg 0\n\n'
+                     'garbage\ndata/images/2.jpg x')
+        self.run_command('--no-cache', 'rebag', self.bagdir)
+        self.assertTrue(bagit.Bag(self.bagdir).is_valid())
+        payload = self.inventory.objects[('bag', '5')]['payload']
+        self.assertIn('data/new 3', payload.split('\n'))
+        self.assertEqual([r[:2] for r in self.client.requests[-2:]],
+                         [('PATCH', 'bag'), ('POST', 'bagaction')])
+
+
+class TestImport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_csv(self):
+        path = os.path.join(self.tmpdir, 'items.csv')
+        with open(path, 'w') as f:
+            f.write('Item Name,Local ID,Collection ID,Item Type,Bag Type,'
+                    'Bag Path,Machine ID,Bag Name,Item Notes,'
+                    'Item Access Location\n'
+                    'Title,L1,7,1,2,/bags/b1,3,b1,,\n')
+        rows = list(clint.read_import_file(path))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['title'], 'Title')
+        self.assertEqual(rows[0]['collection'], '7')
+        self.assertEqual(rows[0]['path'], '/bags/b1')
+        self.assertEqual(rows[0]['machine'], '3')
+        self.assertEqual(rows[0]['notes'], '')
+
+    def test_invalid_file(self):
+        path = os.path.join(self.tmpdir, 'items.txt')
+        self.assertRaises(ValueError, list, clint.read_import_file(path))
+
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = clint.make_parser()
+
+    def test_usage_error(self):
+        status, output, error = clint.run_command(self.parser, ['bogus'])
+        self.assertEqual(status, 2)
+        self.assertIn('invalid choice', error)
+
+    def test_no_nested_serve(self):
+        status, output, error = clint.run_command(self.parser,
+                                                  ['serve', '--stdio'])
+        self.assertEqual(status, 1)
+        self.assertIn('serve', error)
+
+    def test_serve(self):
+        stdin, stdout = sys.stdin, sys.stdout
+        sys.stdin = StringIO('{"id": 7, "argv": ["bogus"]}\n\nnot json\n')
+        sys.stdout = StringIO()
+        try:
+            clint.serve(None)
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+        results = [json.loads(line) for line in lines]
+        self.assertEqual([r['id'] for r in results], [7, None])
+        self.assertEqual([r['status'] for r in results], [2, 2])
+
+
 if __name__ == '__main__':
     unittest.main()